@@ -0,0 +1,70 @@
+"""
+Index of the data cached by pcachefs, used to cap the size of the cache.
+"""
+import threading
+from collections import OrderedDict
+
+
+class CacheIndex(object):
+    """Disk usage of each cached file, least recently used first.
+
+    The index lives in memory only. It is rebuilt by load() from the
+    disk usage and last use of each cache.data file recorded by the
+    metadata store, so that it stays consistent with the cache across
+    restarts. Files used before load() is done are recorded with their
+    disk usage by update(), or with an unknown size by touch() which
+    load() then fills in.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total = 0
+
+    def load(self, found):
+        """Add the given cached files which are not yet indexed.
+
+        found is a list of (last use, path, disk usage), as returned by
+        the list_data() method of metadata stores.
+        """
+        found = sorted(found)
+        with self.lock:
+            entries = OrderedDict()
+            for _, path, size in found:
+                if path not in self.entries:
+                    entries[path] = size
+                    self.total += size
+                elif self.entries[path] is None:
+                    self.entries[path] = size
+                    self.total += size
+
+            # files used since we started are the most recently used
+            entries.update(self.entries)
+            self.entries = entries
+
+    def update(self, path, size):
+        """Record that path, which was just used, takes size bytes on disk."""
+        with self.lock:
+            self.total += size - (self.entries.pop(path, None) or 0)
+            self.entries[path] = size
+
+    def touch(self, path):
+        """Record that path was just used, its size being unknown until load() if not indexed yet."""
+        with self.lock:
+            self.entries[path] = self.entries.pop(path, None)
+
+    def size(self, path):
+        """Return the number of bytes cached for path."""
+        with self.lock:
+            return self.entries.get(path) or 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def remove(self, path):
+        with self.lock:
+            self.total -= self.entries.pop(path, None) or 0
+
+    def least_recently_used(self):
+        """Return the paths in the index, least recently used first."""
+        with self.lock:
+            return list(self.entries)
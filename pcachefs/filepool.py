@@ -0,0 +1,309 @@
+"""
+Pool of open file descriptors used by pcachefs.
+"""
+import errno
+import io
+import mmap
+import os
+import resource
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from pcachefsutil import get_logger
+
+log = get_logger('filepool')
+
+
+# Size of the buffer used to copy data between files
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def default_max_files():
+    """Allow pools to use a quarter of the file descriptors we may open."""
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return 1024
+    return max(16, min(1024, soft_limit // 4))
+
+
+class PooledFile(object):
+    """An open file descriptor and the number of threads using it."""
+    def __init__(self, fd):
+        self.fd = fd
+        self.users = 0
+
+        # Only needed to make seek + read/write atomic when positional
+        # I/O is not available
+        self.lock = threading.Lock()
+
+
+class FilePool(object):
+    """Keeps files open between reads and writes.
+
+    Opening a file can be costly, especially on network filesystems
+    where it is a round trip to the server. This class keeps up to
+    max_files descriptors open, least recently used ones being closed
+    first, and reads and writes them at a given offset without seeking
+    when os.pread() and os.pwrite() are available.
+
+    Descriptors currently used by a thread are never closed under its
+    feet: they are closed once the last user is done with them.
+    """
+    def __init__(self, flags=os.O_RDONLY, max_files=None):
+        self.flags = flags
+        self.max_files = max_files or default_max_files()
+
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+
+    def read(self, filename, size, offset):
+        """Read up to size bytes from filename, starting at offset."""
+        chunks = []
+        with self._acquire(filename) as pooled:
+            while size > 0:
+                chunk = self._pread(pooled, size, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size -= len(chunk)
+                offset += len(chunk)
+
+        return ''.join(chunks)
+
+    def write(self, filename, data, offset):
+        """Write data into filename, starting at offset."""
+        with self._acquire(filename) as pooled:
+            while data:
+                written = self._pwrite(pooled, data, offset)
+                data = data[written:]
+                offset += written
+
+    def copy(self, filename, dest_pool, dest_filename, size, offset):
+        """Copy up to size bytes from filename to dest_filename, both at offset.
+
+        dest_filename is opened through dest_pool. The data goes through
+        a buffer reused by each thread, so that no string is allocated
+        for it.
+
+        Returns the number of bytes copied, which is less than size if
+        the end of filename is reached.
+        """
+        copied = 0
+        with self._acquire(filename) as src, dest_pool._acquire(dest_filename) as dst:  # pylint: disable=protected-access
+            while copied < size:
+                chunk = _copy_chunk(src, dst, size - copied, offset + copied)
+                if not chunk:
+                    break
+                copied += chunk
+
+        return copied
+
+    def close(self, filename):
+        """Close the descriptor of filename, if it is open."""
+        with self.lock:
+            pooled = self.files.pop(filename, None)
+            if pooled is not None and pooled.users == 0:
+                os.close(pooled.fd)
+
+    def close_all(self):
+        """Close all descriptors."""
+        with self.lock:
+            for pooled in self.files.values():
+                if pooled.users == 0:
+                    os.close(pooled.fd)
+            self.files.clear()
+
+    @contextmanager
+    def _acquire(self, filename):
+        with self.lock:
+            pooled = self.files.pop(filename, None)
+            if pooled is not None:
+                # (re-)insert so that filename becomes the most recently used
+                self.files[filename] = pooled
+                pooled.users += 1
+
+        if pooled is None:
+            # Do not hold the lock while opening, it may be slow
+            fd = self._open(filename)
+
+            with self.lock:
+                pooled = self.files.get(filename)
+                if pooled is None:
+                    pooled = self.files[filename] = PooledFile(fd)
+                else:
+                    # another thread opened it in the meantime
+                    os.close(fd)
+                pooled.users += 1
+                self._evict()
+
+        try:
+            yield pooled
+        finally:
+            with self.lock:
+                pooled.users -= 1
+                if pooled.users == 0 and self.files.get(filename) is not pooled:
+                    # closed or evicted while we were using it
+                    os.close(pooled.fd)
+
+    def _open(self, filename):
+        try:
+            return os.open(filename, self.flags)
+        except OSError as e:
+            if e.errno not in (errno.EMFILE, errno.ENFILE):
+                raise
+
+        log.info('FilePool._open out of file descriptors opening %s', filename)
+        with self.lock:
+            self._evict(0)
+
+        return os.open(filename, self.flags)
+
+    def _evict(self, max_files=None):
+        """Close least recently used, unused descriptors until at most max_files are open.
+
+        Must be called with lock held.
+        """
+        if max_files is None:
+            max_files = self.max_files
+
+        excess = len(self.files) - max_files
+        for filename, pooled in list(self.files.items()):
+            if excess <= 0:
+                break
+
+            if pooled.users == 0:
+                del self.files[filename]
+                os.close(pooled.fd)
+                excess -= 1
+
+    @staticmethod
+    def _pread(pooled, size, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(pooled.fd, size, offset)
+
+        with pooled.lock:
+            os.lseek(pooled.fd, offset, os.SEEK_SET)
+            return os.read(pooled.fd, size)
+
+    @staticmethod
+    def _pwrite(pooled, data, offset):
+        if hasattr(os, 'pwrite'):
+            return os.pwrite(pooled.fd, data, offset)
+
+        with pooled.lock:
+            os.lseek(pooled.fd, offset, os.SEEK_SET)
+            return os.write(pooled.fd, data)
+
+
+class MappedFiles(object):
+    """Keeps up to max_files files memory-mapped for reading.
+
+    Reading a mapped file is a mere slice of the mapping, without any
+    system call. Files are mapped up to their size when first read, and
+    mapped again when a read goes past the end of the mapping because
+    the file grew. Least recently used mappings are closed first, and
+    all mappings are closed if the address space runs out.
+
+    Files must not be truncated while mapped, reading past their end
+    would crash the process: close() them first.
+    """
+    def __init__(self, max_files=64):
+        self.max_files = max_files
+
+        self.lock = threading.Lock()
+        self.maps = OrderedDict()
+
+    def read(self, filename, size, offset):
+        """Read up to size bytes from filename, starting at offset.
+
+        Returns None if the file cannot be mapped, in which case it
+        should be read by other means.
+        """
+        with self.lock:
+            mapped = self.maps.pop(filename, None)
+            if mapped is not None:
+                # (re-)insert so that filename becomes the most recently used
+                self.maps[filename] = mapped
+
+        if mapped is None or offset + size > len(mapped):
+            mapped = self._map(filename, mapped)
+            if mapped is None:
+                return None
+
+        try:
+            return mapped[offset:offset+size]
+        except ValueError:
+            # closed by another thread in the meantime
+            return None
+
+    def close(self, filename):
+        """Unmap filename, if it is mapped."""
+        with self.lock:
+            mapped = self.maps.pop(filename, None)
+        if mapped is not None:
+            mapped.close()
+
+    def close_all(self):
+        """Unmap all files."""
+        with self.lock:
+            maps = list(self.maps.values())
+            self.maps.clear()
+        for mapped in maps:
+            mapped.close()
+
+    def _map(self, filename, old_mapped):
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0:
+                return None
+
+            if old_mapped is not None and len(old_mapped) == size:
+                return old_mapped
+
+            try:
+                mapped = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            except (mmap.error, EnvironmentError) as e:
+                log.warning('MappedFiles._map failed for %s, closing all mappings: %s', filename, e)
+                self.close_all()
+                return None
+        finally:
+            os.close(fd)
+
+        with self.lock:
+            self.maps.pop(filename, None)
+            self.maps[filename] = mapped
+
+            evicted = []
+            while len(self.maps) > self.max_files:
+                evicted.append(self.maps.popitem(last=False)[1])
+
+        for evicted_mapped in evicted:
+            evicted_mapped.close()
+        return mapped
+
+
+def _copy_chunk(src, dst, size, offset):
+    """Copy some of size bytes at offset from src to dst, return how many were copied."""
+    buf = _copy_buffer()
+    view = memoryview(buf)[:min(size, len(buf))]
+
+    with src.lock:
+        os.lseek(src.fd, offset, os.SEEK_SET)
+        read = io.FileIO(src.fd, 'r', closefd=False).readinto(view)
+
+    written = 0
+    while written < read:
+        written += FilePool._pwrite(dst, view[written:read], offset + written)  # pylint: disable=protected-access
+
+    return read
+
+
+_local = threading.local()
+def _copy_buffer():
+    """Return the copy buffer of the current thread."""
+    buf = getattr(_local, 'copy_buffer', None)
+    if buf is None:
+        buf = _local.copy_buffer = bytearray(COPY_BUFFER_SIZE)
+    return buf
@@ -0,0 +1,428 @@
+"""
+Storage of the metadata cached by pcachefs.
+
+Two stores are available, with the same interface:
+ - FileMetadataStore keeps metadata in small files mirroring the tree
+   of the cached filesystem, next to the cache.data files;
+ - SqliteMetadataStore keeps all metadata in a single SQLite database.
+
+Stat objects are stored pickled, directory listings as the name and
+type of each entry, and the coverage of cache.data files in the format
+of Ranges.serialize() or BlockBitmap.serialize().
+
+Listings are returned by get_listing() as iterators over (name, type)
+starting at a given entry, which do not load the whole listing in
+memory, so that very large directories can be listed page by page.
+"""
+import errno
+import io
+import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+# We explicitly refer to __builtin__ here so it can be mocked
+import __builtin__
+
+
+# Listings are stored in files as a header, the position in the file of
+# each entry, and the entries as (type, length of name, name), so that
+# they can be read from any entry
+LISTING_MAGIC = 'PCFL'
+LISTING_VERSION = 1
+LISTING_HEADER = struct.Struct('<4sB3xQ')
+LISTING_POSITION = struct.Struct('<Q')
+LISTING_ENTRY = struct.Struct('<BH')
+
+
+def get_cache_path(cachedir, path, file=None):
+    """For a given path, return the name of the directory used to cache data for that path."""
+    if path[0] != '/':
+        raise ValueError("Expected leading slash")
+
+    if file is None:
+        return os.path.join(cachedir, path[1:])
+
+    return os.path.join(cachedir, path[1:], file)
+
+
+def walk_data(cachedir):
+    """Yield (path, name of the cache.data file) for each cache.data file under cachedir."""
+    for dirpath, _, filenames in os.walk(cachedir):
+        if 'cache.data' in filenames:
+            yield os.sep + os.path.relpath(dirpath, cachedir), os.path.join(dirpath, 'cache.data')
+
+
+def makedirs(path):
+    """Create the given directory if it does not already exist."""
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            # another thread may have created it in the meantime
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def write_file_atomically(filename, content):
+    """Replace the content of the given file atomically.
+
+    The content is written to a temporary file which is then renamed,
+    so that concurrent readers and interrupted writes never see a
+    truncated file.
+    """
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def serialize_listing(entries):
+    """Return the given list of (name, type) in the listing file format."""
+    positions = []
+    records = []
+    position = LISTING_HEADER.size + LISTING_POSITION.size * len(entries)
+    for name, type in entries:
+        record = LISTING_ENTRY.pack(type, len(name)) + name
+        positions.append(LISTING_POSITION.pack(position))
+        records.append(record)
+        position += len(record)
+
+    return ''.join([LISTING_HEADER.pack(LISTING_MAGIC, LISTING_VERSION, len(entries))] + positions + records)
+
+
+def read_listing(f, offset=0):
+    """Return an iterator over the (name, type) of the listing file f, starting at the offset-th.
+
+    Returns None if f is not in the listing file format. f is closed
+    once the iterator is exhausted or discarded.
+    """
+    header = f.read(LISTING_HEADER.size)
+    if len(header) < LISTING_HEADER.size:
+        return None
+
+    magic, version, count = LISTING_HEADER.unpack(header)
+    if magic != LISTING_MAGIC or version != LISTING_VERSION:
+        return None
+
+    return _read_listing_entries(f, offset, count)
+
+
+def _read_listing_entries(f, offset, count):
+    try:
+        if offset >= count:
+            return
+
+        f.seek(LISTING_HEADER.size + LISTING_POSITION.size * offset)
+        position, = LISTING_POSITION.unpack(f.read(LISTING_POSITION.size))
+        f.seek(position)
+
+        for _ in xrange(count - offset):
+            type, length = LISTING_ENTRY.unpack(f.read(LISTING_ENTRY.size))
+            yield f.read(length), type
+    finally:
+        f.close()
+
+
+class FileMetadataStore(object):
+    """Metadata stored in files, in the directory caching each path.
+
+      /cache/dir/filename.ext/cache.data.range  # coverage of cache.data
+      /cache/dir/filename.ext/cache.stat  # pickle'd stat object
+      /cache/dir/cache.list # directory listing, see serialize_listing()
+
+    The last use of a cache.data file is its modification time.
+    """
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+
+    def _read(self, path, file):
+        filename = get_cache_path(self.cachedir, path, file)
+        if not os.path.exists(filename):
+            return None
+
+        with __builtin__.open(filename, 'rb') as f:
+            return f.read()
+
+    def _write(self, path, file, content):
+        makedirs(get_cache_path(self.cachedir, path))
+        write_file_atomically(get_cache_path(self.cachedir, path, file), content)
+
+    def _remove(self, path, file):
+        filename = get_cache_path(self.cachedir, path, file)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def get_stat(self, path):
+        content = self._read(path, 'cache.stat')
+        return None if content is None else pickle.loads(content)
+
+    def put_stat(self, path, stat):
+        self._write(path, 'cache.stat', pickle.dumps(stat))
+
+    def put_stats(self, stats):
+        """Store the given (path, stat object)."""
+        for path, stat in stats:
+            self.put_stat(path, stat)
+
+    def remove_stat(self, path):
+        self._remove(path, 'cache.stat')
+
+    def get_listing(self, path, offset=0):
+        filename = get_cache_path(self.cachedir, path, 'cache.list')
+        if not os.path.exists(filename):
+            return None
+
+        f = io.open(filename, 'rb')
+        try:
+            listing = read_listing(f, offset)
+        except BaseException:
+            f.close()
+            raise
+
+        if listing is None:
+            # pickled by an older version
+            f.close()
+        return listing
+
+    def put_listing(self, path, listing):
+        self._write(path, 'cache.list', serialize_listing(listing))
+
+    def remove_listing(self, path):
+        self._remove(path, 'cache.list')
+
+    def get_coverage(self, path):
+        return self._read(path, 'cache.data.range')
+
+    def put_coverage(self, path, coverage):
+        self._write(path, 'cache.data.range', coverage)
+
+    def remove_coverage(self, path):
+        self._remove(path, 'cache.data.range')
+
+    def touch_data(self, path):
+        """Record that the cache.data of path was just used."""
+        cache_data = get_cache_path(self.cachedir, path, 'cache.data')
+        if os.path.exists(cache_data):
+            os.utime(cache_data, None)
+
+    def list_data(self):
+        """Return (last use, path, disk usage) for each cache.data file."""
+        found = []
+        for path, cache_data in walk_data(self.cachedir):
+            try:
+                st = os.stat(cache_data)
+            except OSError:
+                # removed in the meantime
+                continue
+
+            found.append((st.st_mtime, path, st.st_blocks * 512))
+
+        return found
+
+    def commit(self):
+        """Make sure all changes are on disk."""
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteMetadataStore(object):
+    """Metadata stored in a SQLite database, cache.db in the cache directory.
+
+    This avoids creating a directory and several small files for each
+    path of the cached filesystem, and makes whole cache queries cheap.
+
+    Listings are stored as one row per entry, and read by pages of
+    page_size entries.
+
+    The database is in WAL mode and changes are committed in batches of
+    at most batch_size changes, and whenever commit() is called. Changes
+    not committed yet are visible to all threads since they share a
+    single connection.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS stat (
+            path TEXT PRIMARY KEY,
+            stat BLOB NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS directory (
+            path TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS entry (
+            path TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            type INTEGER NOT NULL,
+            PRIMARY KEY (path, idx)
+        );
+        CREATE TABLE IF NOT EXISTS coverage (
+            path TEXT PRIMARY KEY,
+            coverage BLOB NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            last_used REAL NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS coverage_last_used ON coverage (last_used);
+    '''
+
+    def __init__(self, cachedir, batch_size=1000, page_size=1000):
+        self.cachedir = cachedir
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.pending = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cachedir, 'cache.db'), check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+
+    def _get(self, query, path):
+        with self.lock:
+            row = self.db.execute(query, (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def _change(self, query, args):
+        self._change_many(query, [args])
+
+    def _change_many(self, query, args_list):
+        if args_list:
+            self._change_together([(query, args_list)])
+
+    def _change_together(self, changes):
+        """Run the given (query, list of args) at once, so that nobody sees some of them only."""
+        with self.lock:
+            for query, args_list in changes:
+                self.db.executemany(query, args_list)
+                self.pending += len(args_list)
+
+            if self.pending >= self.batch_size:
+                self.db.commit()
+                self.pending = 0
+
+    def get_stat(self, path):
+        content = self._get('SELECT stat FROM stat WHERE path = ?', path)
+        return None if content is None else pickle.loads(str(content))
+
+    def put_stat(self, path, stat):
+        self._change('INSERT OR REPLACE INTO stat (path, stat) VALUES (?, ?)',
+                     (path, sqlite3.Binary(pickle.dumps(stat, pickle.HIGHEST_PROTOCOL))))
+
+    def put_stats(self, stats):
+        """Store the given (path, stat object)."""
+        self._change_many('INSERT OR REPLACE INTO stat (path, stat) VALUES (?, ?)',
+                          [(path, sqlite3.Binary(pickle.dumps(stat, pickle.HIGHEST_PROTOCOL)))
+                           for path, stat in stats])
+
+    def remove_stat(self, path):
+        self._change('DELETE FROM stat WHERE path = ?', (path,))
+
+    def get_listing(self, path, offset=0):
+        # The first page is read along with the directory, so that it
+        # comes from the same listing even if it is being replaced
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM directory WHERE path = ?', (path,)).fetchone() is None:
+                return None
+            rows = self._read_page(path, offset)
+        return self._read_listing(path, offset, rows)
+
+    def _read_page(self, path, offset):
+        return self.db.execute('SELECT idx, name, type FROM entry WHERE path = ? AND idx >= ? '
+                               'ORDER BY idx LIMIT ?', (path, offset, self.page_size)).fetchall()
+
+    def _read_listing(self, path, offset, rows):
+        while True:
+            for _, name, type in rows:
+                yield name, type
+
+            if len(rows) < self.page_size:
+                return
+            offset = rows[-1][0] + 1
+
+            with self.lock:
+                rows = self._read_page(path, offset)
+
+    def put_listing(self, path, listing):
+        self._change_together(self._removing_listing(path) + [
+            ('INSERT INTO directory (path) VALUES (?)', [(path,)]),
+            ('INSERT INTO entry (path, idx, name, type) VALUES (?, ?, ?, ?)',
+             [(path, idx, name, type) for idx, (name, type) in enumerate(listing)]),
+        ])
+
+    def remove_listing(self, path):
+        self._change_together(self._removing_listing(path))
+
+    def _removing_listing(self, path):  # pylint: disable=no-self-use
+        return [('DELETE FROM directory WHERE path = ?', [(path,)]),
+                ('DELETE FROM entry WHERE path = ?', [(path,)])]
+
+    def get_coverage(self, path):
+        content = self._get('SELECT coverage FROM coverage WHERE path = ?', path)
+        return None if content is None else str(content)
+
+    def put_coverage(self, path, coverage):
+        # Keep the disk usage of cache.data along with its coverage so
+        # that list_data() does not have to stat every file
+        try:
+            size = os.stat(get_cache_path(self.cachedir, path, 'cache.data')).st_blocks * 512
+        except OSError:
+            size = 0
+
+        self._change('INSERT OR REPLACE INTO coverage (path, coverage, size, last_used) '
+                     'VALUES (?, ?, ?, COALESCE((SELECT last_used FROM coverage WHERE path = ?), ?))',
+                     (path, sqlite3.Binary(coverage), size, path, time.time()))
+
+    def remove_coverage(self, path):
+        self._change('DELETE FROM coverage WHERE path = ?', (path,))
+
+    def touch_data(self, path):
+        """Record that the cache.data of path was just used."""
+        self._change('UPDATE coverage SET last_used = ? WHERE path = ?', (time.time(), path))
+
+    def list_data(self):
+        """Return (last use, path, disk usage) for each cache.data file.
+
+        cache.data files are only known to the database once their
+        coverage is written, so the cache directory is still walked for
+        those written since, or before an unclean stop, which are the
+        only ones looked up.
+        """
+        with self.lock:
+            known = dict((path, (last_used, size)) for last_used, path, size in
+                         self.db.execute('SELECT last_used, path, size FROM coverage'))
+
+        found = []
+        for path, cache_data in walk_data(self.cachedir):
+            if path in known:
+                found.append((known[path][0], path, known[path][1]))
+                continue
+
+            try:
+                st = os.stat(cache_data)
+            except OSError:
+                # removed in the meantime
+                continue
+
+            found.append((st.st_mtime, path, st.st_blocks * 512))
+
+        found.sort()
+        return found
+
+    def commit(self):
+        """Make sure all changes are on disk."""
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,146 @@
+"""
+Runtime metrics of pcachefs: counters and latency histograms.
+"""
+import json
+import thread
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# Upper bounds of the buckets of latency histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf'))
+
+
+class MetricsShard(object):
+    """Counters and histograms updated by a single thread."""
+    def __init__(self):
+        self.counters = {}
+
+        # name -> [count of each bucket..., sum]
+        self.histograms = {}
+
+    def merge(self, other):
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+        for name, values in other.histograms.items():
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                self.histograms[name] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    histogram[i] += value
+
+
+class Metrics(object):
+    """Counters and latency histograms which can be updated by many threads.
+
+    Each thread updates its own MetricsShard without any lock, shards
+    are only summed up by snapshot(). Shards are keyed by thread
+    identifier rather than stored in thread-local data: FUSE calls come
+    from threads created in C, which Python may forget between two
+    calls, and a thread reusing the identifier of one which ended can
+    safely carry on with its shard. There are thus never more shards
+    than threads alive at once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # thread identifier -> MetricsShard
+        self.shards = {}
+
+    def inc(self, name, amount=1):
+        """Add amount to the counter name."""
+        counters = self._get_shard().counters
+        counters[name] = counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """Record a duration in the histogram name."""
+        histograms = self._get_shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = [0] * (len(LATENCY_BUCKETS) + 1)
+
+        histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    @contextmanager
+    def timed(self, name):
+        """Record the duration of the with block in the histogram name."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def snapshot(self):
+        """Return the sum of the MetricsShard of all threads."""
+        total = MetricsShard()
+        with self.lock:
+            shards = self.shards.values()
+
+        for shard in shards:
+            # copied first since the thread may be updating them
+            copy = MetricsShard()
+            copy.counters = dict(shard.counters)
+            copy.histograms = dict((name, list(values)) for name, values in shard.histograms.items())
+            total.merge(copy)
+        return total
+
+    def _get_shard(self):
+        ident = thread.get_ident()
+        shard = self.shards.get(ident)
+        if shard is None:
+            with self.lock:
+                shard = self.shards[ident] = MetricsShard()
+        return shard
+
+
+def format_json(shard, gauges):
+    """Format metrics as JSON.
+
+    shard is a MetricsShard as returned by Metrics.snapshot(), gauges a
+    dict of current values.
+    """
+    histograms = {}
+    for name, values in shard.histograms.items():
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(LATENCY_BUCKETS, values):
+            cumulative += count
+            buckets.append(['+Inf' if bound == float('inf') else bound, cumulative])
+        histograms[name] = {'buckets': buckets, 'count': cumulative, 'sum': values[-1]}
+
+    return json.dumps({'counters': shard.counters, 'histograms': histograms, 'gauges': gauges},
+                      indent=2, separators=(',', ': '), sort_keys=True) + '\n'
+
+
+def format_prometheus(shard, gauges, prefix='pcachefs_'):
+    """Format metrics in the Prometheus text exposition format.
+
+    Counters are named <prefix><name>_total and histograms
+    <prefix><name>_seconds.
+    """
+    lines = []
+    for name, value in sorted(shard.counters.items()):
+        lines.append('# TYPE %s%s_total counter' % (prefix, name))
+        lines.append('%s%s_total %s' % (prefix, name, value))
+
+    for name, values in sorted(shard.histograms.items()):
+        metric = '%s%s_seconds' % (prefix, name)
+        lines.append('# TYPE %s histogram' % metric)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, values):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket{le="%s"} %d' % (metric, le, cumulative))
+        lines.append('%s_sum %r' % (metric, values[-1]))
+        lines.append('%s_count %d' % (metric, cumulative))
+
+    for name, value in sorted(gauges.items()):
+        lines.append('# TYPE %s%s gauge' % (prefix, name))
+        lines.append('%s%s %s' % (prefix, name, value))
+
+    return '\n'.join(lines) + '\n'
@@ -19,25 +19,45 @@
 
 """
 
+import errno
+import itertools
 import os
 import pickle
+import Queue
 import signal
 import stat
+import tempfile
+import threading
+import time
 # We explicitly refer to __builtin__ here so it can be mocked
 import __builtin__
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from pprint import pformat
 
 import fuse
 
 import vfs
-from ranges import (Ranges, Range)
-from pcachefsutil import debug, is_read_only_flags
+import ranges
+from filepool import (FilePool, MappedFiles)
+from metrics import Metrics
+from prefetch import Prefetcher
+from tracing import (SignalDumper, Tracer, traced)
+from cacheindex import CacheIndex
+from metadata import (FileMetadataStore, SqliteMetadataStore, get_cache_path, makedirs)
+from ranges import (Ranges, Range, BlockBitmap)
+from pcachefsutil import (configure_logging, get_logger, is_read_only_flags, parse_size, PathLocks, LRUCache)
 from pcachefsutil import E_PERM_DENIED, E_NOT_IMPL
 
 
 fuse.fuse_python_api = (0, 2)
 
+fs_log = get_logger('fs')
+underlying_log = get_logger('underlying')
+log = get_logger('cacher')
+
 
 class FuseStat(fuse.Stat):
     """Convenient class for Stat objects.
@@ -64,7 +84,7 @@ class FuseStat(fuse.Stat):
         self.st_blksize = st.st_blksize
 
     def __repr__(self):
-        v = vars(self)
+        v = dict(vars(self))
         v['is_dir'] = stat.S_ISDIR(v['st_mode'])
         v['is_char_dev'] = stat.S_ISCHR(v['st_mode'])
         v['is_block_dev'] = stat.S_ISBLK(v['st_mode'])
@@ -75,6 +95,15 @@ class FuseStat(fuse.Stat):
         return pformat(v)
 
 
+# Type of directories in Direntry objects
+DT_DIR = stat.S_IFDIR >> 12
+
+
+def dirent_type(st):
+    """Return the type of a Direntry object for a stat object."""
+    return stat.S_IFMT(st.st_mode) >> 12
+
+
 class PersistentCacheFs(fuse.Fuse):
     """Main FUSE class
 
@@ -83,18 +112,37 @@ class PersistentCacheFs(fuse.Fuse):
     def __init__(self, *args, **kw):
         fuse.Fuse.__init__(self, *args, **kw)
 
-        # Currently we have to run in single-threaded mode to prevent
-        # the cache becoming corrupted
-        self.parse(['-s'])
-
         self.parser.add_option('-c', '--cache-dir', dest='cache_dir', help="Specifies the directory where cached data should be stored. This will be created if it does not exist.")
         self.parser.add_option('-t', '--target-dir', dest='target_dir', help="The directory which we are caching. The content of this directory will be mirrored and all reads cached.")
         self.parser.add_option('-v', '--virtual-dir', dest='virtual_dir', help="The folder in the mount dir in which the virtual filesystem controlling pcachefs will reside.")
+        self.parser.add_option('--max-readahead', dest='max_readahead', default='4M', help="Maximum amount of data fetched ahead of a file being read sequentially (e.g. 16M, 0 to disable). Defaults to 4M.")
+        self.parser.add_option('--max-cache-size', dest='max_cache_size', help="Maximum size of the cache directory (e.g. 500G). Least recently used files are removed from the cache when it grows larger. By default the cache grows without limit.")
+        self.parser.add_option('--metadata', dest='metadata', type='choice', choices=['files', 'sqlite'], default='files', help="Where to store cached metadata: 'files' next to the cached data (the default) or 'sqlite' in a single database in the cache directory.")
+        self.parser.add_option('--block-size', dest='block_size', help="Track cached data in blocks of this size (e.g. 1M) and always fetch whole aligned blocks from the target. By default exactly the bytes read are fetched.")
+        self.parser.add_option('--attr-timeout', dest='attr_timeout', type='float', help="Number of seconds after which cached file attributes are checked against the target. Files whose modification time or size changed are then removed from the cache. By default cached attributes are never checked.")
+        self.parser.add_option('--listing-timeout', dest='listing_timeout', type='float', help="Number of seconds after which cached directory listings are checked against the modification time of the directory on the target, and listed again if it changed. By default cached listings are never checked.")
+        self.parser.add_option('--max-stale', dest='max_stale', type='float', default=0, help="Number of seconds past --attr-timeout or --listing-timeout during which cached attributes and listings are still returned right away, while they are checked against the target in the background. Defaults to 0, checking them before returning.")
+        self.parser.add_option('--negative-timeout', dest='negative_timeout', type='float', help="Number of seconds during which paths found not to exist on the target are reported missing without asking it again. By default missing paths are not cached.")
+        self.parser.add_option('--stat-threads', dest='stat_threads', type='int', default=8, help="Number of threads getting the attributes of the entries of a directory on the target when it is listed. Defaults to 8.")
+        self.parser.add_option('--prefetch-threads', dest='prefetch_threads', type='int', default=2, help="Number of threads fetching directory trees queued by writing 1 to the prefetch file of a directory under the virtual directory. Defaults to 2.")
+        self.parser.add_option('--log-level', dest='log_level', default='warning', help="Level of the messages logged: debug, info, warning or error, optionally followed by the levels of subsystems among fs, underlying, cacher, vfs, filepool, prefetch and tracing (e.g. warning,cacher=debug). Defaults to warning.")
+        self.parser.add_option('--log-sample', dest='log_sample', default='', help="Only log one debug message out of so many for the given subsystems (e.g. fs=100,cacher=10). By default all of them are logged.")
+        self.parser.add_option('--log-file', dest='log_file', help="File to which messages are logged. Defaults to the standard error, which is discarded once running in the background.")
+        self.parser.add_option('--trace', dest='trace', action='store_true', default=False, help="Record the time spent in each step of operations from the start. Tracing can also be enabled and disabled by writing 1 or 0 to the trace file of the virtual directory, which returns the spans recorded as Chrome trace-event JSON.")
+        self.parser.add_option('--trace-spans', dest='trace_spans', type='int', default=100000, help="Number of the most recent spans kept while tracing. Defaults to 100000.")
+        self.parser.add_option('--trace-file', dest='trace_file', default=os.path.join(tempfile.gettempdir(), 'pcachefs-trace.json'), help="File to which the spans recorded are written on SIGUSR1. Defaults to pcachefs-trace.json in the temporary directory.")
+        self.parser.add_option('--mmap-files', dest='mmap_files', type='int', default=0, help="Number of recently read cached files to keep memory-mapped, so that cache hits are served without system calls. Defaults to 0, which disables memory mapping.")
 
         self.cache_dir = None
         self.target_dir = None
         self.virtual_dir = None
+        self.block_size = None
+        self.max_readahead = None
+        self.max_cache_size = None
         self.cacher = None
+        self.prefetcher = None
+        self.tracer = None
+        self.signal_dumper = None
         self.vfs = None
 
     def main(self, args=None):
@@ -109,73 +157,140 @@ class PersistentCacheFs(fuse.Fuse):
         self.target_dir = options.target_dir
         self.virtual_dir = options.virtual_dir or '.pcachefs'
 
-        self.cacher = Cacher(self.cache_dir, UnderlyingFs(self.target_dir))
-        self.vfs = vfs.VirtualFS(self.virtual_dir, self.cacher)
-
+        if options.block_size is not None:
+            try:
+                self.block_size = parse_size(options.block_size)
+                if self.block_size < 1:
+                    raise ValueError('block size must be positive')
+            except ValueError:
+                self.parser.error('Invalid --block-size ' + options.block_size)
+
+        try:
+            self.max_readahead = parse_size(options.max_readahead)
+        except ValueError:
+            self.parser.error('Invalid --max-readahead ' + options.max_readahead)
+
+        if options.max_cache_size is not None:
+            try:
+                self.max_cache_size = parse_size(options.max_cache_size)
+            except ValueError:
+                self.parser.error('Invalid --max-cache-size ' + options.max_cache_size)
+
+        try:
+            configure_logging(options.log_level, options.log_sample, options.log_file)
+        except ValueError as e:
+            self.parser.error('Invalid --log-level or --log-sample: %s' % e)
+
+        self.cacher = Cacher(self.cache_dir, UnderlyingFs(self.target_dir, stat_threads=options.stat_threads),
+                             block_size=self.block_size, max_readahead=self.max_readahead,
+                             max_cache_size=self.max_cache_size,
+                             metadata=options.metadata,
+                             max_mapped_files=options.mmap_files,
+                             attr_timeout=options.attr_timeout,
+                             listing_timeout=options.listing_timeout,
+                             max_stale=options.max_stale,
+                             negative_timeout=options.negative_timeout,
+                             max_trace_spans=options.trace_spans)
+        self.tracer = self.cacher.tracer
+        self.tracer.enabled = options.trace
+        self.signal_dumper = SignalDumper(self.tracer, options.trace_file)
+        self.prefetcher = Prefetcher(self.cacher, threads=options.prefetch_threads)
+        self.vfs = vfs.VirtualFS(self.virtual_dir, self.cacher, self.prefetcher)
+
+        # With the default handler, FUSE installs its own which unmounts
+        # cleanly, calling fsdestroy()
         signal.signal(signal.SIGINT, signal.SIG_DFL)
         fuse.Fuse.main(self, args)
 
+    def fsinit(self):
+        fs_log.debug('PersistentCacheFs.fsinit')
+        # Background work must be started here rather than in main()
+        # because FUSE forks when daemonizing and threads do not survive
+        self.cacher.start()
+        self.prefetcher.start()
+        self.signal_dumper.start()
+
+    def fsdestroy(self):
+        fs_log.debug('PersistentCacheFs.fsdestroy')
+        self.signal_dumper.stop()
+        self.prefetcher.stop()
+        self.cacher.stop()
+
+    @traced('PersistentCacheFs.getattr')
     def getattr(self, path):
-        debug('PersistentCacheFs.getattr', path)
+        fs_log.debug('PersistentCacheFs.getattr %s', path)
         if self.vfs.contains(path):
             return self.vfs.getattr(path)
 
-        return self.cacher.getattr(path)
+        with self.cacher.metrics.timed('getattr'):
+            return self.cacher.getattr(path)
 
     def readdir(self, path, offset):
-        debug('PersistentCacheFs.readdir', path, offset)
-        for f in self.vfs.readdir(path, offset):
+        fs_log.debug('PersistentCacheFs.readdir %s %s', path, offset)
+        # Entries of the virtual filesystem come first, the offsets of
+        # those of the cacher are shifted accordingly
+        count = 0
+        for f in self.vfs.readdir(path):
             if f is None:
                 return
-            yield f
+            count += 1
+            if count > offset:
+                f.offset = count
+                yield f
 
-        for f in self.cacher.readdir(path, offset):
-            yield f
+        with self.cacher.metrics.timed('readdir'):
+            for f in self.cacher.readdir(path, max(0, offset - count)):
+                f.offset += count
+                yield f
 
+    @traced('PersistentCacheFs.open')
     def open(self, path, flags):
-        debug('PersistentCacheFs.open', path, flags)
+        fs_log.debug('PersistentCacheFs.open %s %s', path, flags)
         if self.vfs.contains(path):
             return self.vfs.open(path, flags)
 
         if not is_read_only_flags(flags):
             return E_PERM_DENIED
 
-        return 0
+        return self.cacher.open(path, flags)
 
+    @traced('PersistentCacheFs.read')
     def read(self, path, size, offset):
-        debug('PersistentCacheFs.read', path, size, offset)
+        fs_log.debug('PersistentCacheFs.read %s %s %s', path, size, offset)
         if self.vfs.contains(path):
             return self.vfs.read(path, size, offset)
 
-        return self.cacher.read(path, size, offset)
+        with self.cacher.metrics.timed('read'):
+            return self.cacher.read(path, size, offset)
 
     def truncate(self, path, size):
-        debug('PersistentCacheFs.truncate', path, size)
+        fs_log.debug('PersistentCacheFs.truncate %s %s', path, size)
         if self.vfs.contains(path):
             return self.vfs.truncate(path, size)
 
         return E_NOT_IMPL
 
     def write(self, path, buf, offset):
-        debug('PersistentCacheFs.write', path, buf, offset)
+        fs_log.debug('PersistentCacheFs.write %s %d bytes at %d', path, len(buf), offset)
         if self.vfs.contains(path):
             return self.vfs.write(path, buf, offset)
 
         return E_NOT_IMPL
 
     def flush(self, path):
-        debug('PersistentCacheFs.flush', path)
+        fs_log.debug('PersistentCacheFs.flush %s', path)
         if self.vfs.contains(path):
             return self.vfs.flush(path)
 
-        return 0 # success
+        return self.cacher.flush(path)
 
+    @traced('PersistentCacheFs.release')
     def release(self, path, what):
-        debug('PersistentCacheFs.release', path, what)
+        fs_log.debug('PersistentCacheFs.release %s %s', path, what)
         if self.vfs.contains(path):
             return self.vfs.release(path)
 
-        return 0 # success
+        return self.cacher.release(path, what)
 
 #    def _getattr_special(self, path):
 #        return FuseStat(os.stat('/proc/version')) # FIXME stat of the FUSE mountpoint
@@ -218,9 +333,18 @@ class PersistentCacheFs(fuse.Fuse):
 
 class UnderlyingFs(object):
     """Implementation of FUSE operations that fetches data from the underlying FS."""
-    def __init__(self, real_path):
+    def __init__(self, real_path, stat_threads=8):
         self.real_path = real_path
 
+        # Files are kept open between reads, until released
+        self.files = FilePool()
+
+        # Started on first use, since FUSE forks when going to the
+        # background
+        self.stat_threads = stat_threads
+        self.stat_pool = None
+        self.stat_pool_lock = threading.Lock()
+
     def _get_real_path(self, path):
         if path[0] != '/':
             raise ValueError("Expected leading slash")
@@ -228,11 +352,11 @@ class UnderlyingFs(object):
         return os.path.join(self.real_path, path[1:])
 
     def getattr(self, path):
-        debug('UnderlyingFs.getattr', path)
+        underlying_log.debug('UnderlyingFs.getattr %s', path)
         return FuseStat(os.stat(self._get_real_path(path)))
 
     def readdir(self, path, offset):
-        debug('UnderlyingFs.readdir', path, offset)
+        underlying_log.debug('UnderlyingFs.readdir %s %s', path, offset)
         real_path = self._get_real_path(path)
 
         dirents = []
@@ -244,15 +368,58 @@ class UnderlyingFs(object):
         # return a generator over the entries in the directory
         return (fuse.Direntry(r) for r in dirents)
 
-    def read(self, path, size, offset):
-        debug('UnderlyingFs.read', path, size, offset)
+    def readdir_stats(self, path):
+        """List the given directory along with the stat objects of its entries.
+
+        Returns the list of Direntry objects returned by readdir(), with
+        their type set, and a list of (name, stat object) for the entries
+        of the directory. Entries are stat'ed by stat_threads threads,
+        so that round trips to a remote filesystem overlap. Those removed
+        in the meantime are left out.
+        """
+        underlying_log.debug('UnderlyingFs.readdir_stats %s', path)
         real_path = self._get_real_path(path)
+        names = os.listdir(real_path)
 
-        with __builtin__.open(real_path, 'rb') as f:
-            f.seek(offset)
-            result = f.read(size)
+        def stat_entry(name):
+            try:
+                return name, FuseStat(os.stat(os.path.join(real_path, name)))
+            except OSError:
+                return name, None
 
-        return result
+        if self.stat_threads > 1 and len(names) > 1:
+            stats = self._get_stat_pool().map(stat_entry, names, chunksize=16)
+        else:
+            stats = [stat_entry(name) for name in names]
+
+        dirents = [fuse.Direntry(r, type=DT_DIR) for r in ['.', '..']]
+        dirents.extend(fuse.Direntry(name, type=0 if st is None else dirent_type(st))
+                       for name, st in stats)
+        return dirents, [(name, st) for name, st in stats if st is not None]
+
+    def _get_stat_pool(self):
+        with self.stat_pool_lock:
+            if self.stat_pool is None:
+                self.stat_pool = ThreadPool(self.stat_threads)
+            return self.stat_pool
+
+    def read(self, path, size, offset):
+        underlying_log.debug('UnderlyingFs.read %s %s %s', path, size, offset)
+        return self.files.read(self._get_real_path(path), size, offset)
+
+    def copy(self, path, size, offset, dest_pool, dest_filename):
+        """Copy data of the given file into dest_filename, at the same offset.
+
+        dest_filename is opened through the FilePool dest_pool. Returns
+        the number of bytes copied.
+        """
+        underlying_log.debug('UnderlyingFs.copy %s %s %s %s', path, size, offset, dest_filename)
+        return self.files.copy(self._get_real_path(path), dest_pool, dest_filename, size, offset)
+
+    def release(self, path):
+        """Close the file if it was kept open by read()."""
+        underlying_log.debug('UnderlyingFs.release %s', path)
+        self.files.close(self._get_real_path(path))
 
 
 class Cacher(object):
@@ -267,14 +434,77 @@ class Cacher(object):
 
     The cached files are stored as follows in the cache directory:
       /cache/dir/filename.ext/cache.data   # copy of file data
-      /cache/dir/filename.ext/cache.stat  # pickle'd stat object (from os.stat())
-      /cache/dir/cache.list # pickle'd directory listing (from os.listdir())
+
+    The metadata (stat objects, directory listings and the Ranges or
+    BlockBitmap of each cache.data) is kept either in files next to
+    cache.data (see FileMetadataStore) or in a SQLite database (see
+    SqliteMetadataStore).
+
+    All methods can be called from multiple threads. Creation and
+    removal of the cache files of a path, and loads and writes of its
+    Ranges, are serialized by a lock per path, blocks_lock only guarding
+    the Ranges in memory for all paths. The underlying filesystem is
+    always accessed without holding any lock so that a slow fetch never
+    delays requests for data already cached. Reads and writes of
+    cache.data use positional I/O on pooled descriptors and need no
+    lock.
+
+    The Ranges of each file are kept in memory once loaded and are only
+    written back to the metadata store when they changed, either when the
+    file is flushed or released or periodically every flush_interval
+    seconds. At most max_cached_blocks Ranges are kept in memory, those
+    of files which are not open anymore being evicted first.
+
+    If max_cache_size is given, a background thread removes the cached
+    data of the least recently used files which are not open whenever
+    the cache grows larger, until it is back under 90% of that size.
+
+    The last max_cached_stats stat objects used are also kept in memory,
+    so that frequent getattr() calls do not have to load cache.stat.
+    They are shared and must not be modified.
+
+    If attr_timeout is given, a stat object cached for longer is checked
+    against the underlying filesystem when it is next used. If the
+    modification time or size of a file changed, its cached data is
+    removed, and if those of a directory changed, its listing is. This
+    costs one getattr() on the underlying filesystem per path and
+    timeout, and nothing else. Likewise, a directory listing cached for
+    longer than listing_timeout is kept only if the directory did not
+    change. The time at which each stat object and listing was last
+    checked is only kept in memory, so that they are all checked again
+    after a restart.
+
+    Once start() has been called, a stat object or listing which was
+    last checked less than max_stale seconds after its timeout expired
+    is returned right away, and checked by one of refresh_threads
+    threads. Only older ones are checked before being returned.
+
+    If negative_timeout is given, the last max_missing paths which
+    getattr() did not find on the underlying filesystem are remembered
+    for that many seconds, in memory only, or until the listing of their
+    directory is fetched again and contains them.
+
+    Once start() has been called, data fetched for a read is written to
+    cache.data by background threads after the read has returned, and
+    read-ahead is fetched in the background too. At most
+    max_write_behind of these tasks can be queued, further reads wait
+    until there is room. stop() waits for all of them to be done.
+
+    Counts and latencies of reads, fetches from the underlying
+    filesystem and evictions are recorded in metrics, see get_metrics().
+    If tracer is enabled, the time spent in each step of operations is
+    recorded there too.
 
     For writes to files in the cache, these are passed through to the
     underlying filesystem without any caching.
     """
 
-    def __init__(self, cachedir, underlying_fs):
+    def __init__(self, cachedir, underlying_fs, max_cached_blocks=1024, flush_interval=30, block_size=None, max_readahead=0, max_cache_size=None,
+                 max_cached_stats=10000, metadata='files', max_write_behind=64,
+                 write_threads=2, max_mapped_files=0, attr_timeout=None,
+                 listing_timeout=None, max_stale=0, refresh_threads=2,
+                 max_refresh=1024, negative_timeout=None, max_missing=10000,
+                 max_trace_spans=100000):
         """
         Initialise a new Cacher.
 
@@ -283,7 +513,44 @@ class Cacher(object):
         underlying_fs an object supporting the read(), readdir() and
         getattr() FUSE operations. For any files/dirs not in the cache,
         this object's methods will be called to retrieve the real data
-        and populate the cache.
+        and populate the cache. Its release() method is called once a
+        file is not open anymore. If it has a copy() method (see
+        UnderlyingFs.copy()), it is used to fill cache.data without
+        allocating a string for each block.
+        max_cached_blocks the number of files whose Ranges are kept in
+        memory.
+        flush_interval the number of seconds between two writes of the
+        modified Ranges to disk (0 disables periodic writes).
+        block_size if given, track cached data with a BlockBitmap of
+        blocks of that size instead of Ranges, so that data is always
+        fetched in whole aligned blocks.
+        max_readahead the maximum number of bytes fetched past the end
+        of a read when a file is read sequentially.
+        max_cache_size the maximum number of bytes of cached data.
+        max_cached_stats the number of stat objects kept in memory.
+        metadata 'files' or 'sqlite', the metadata store to use.
+        max_write_behind the number of background writes and read-ahead
+        fetches which can be queued.
+        write_threads the number of threads doing them.
+        max_mapped_files the number of cache.data files kept
+        memory-mapped to serve cached data (0 disables memory mapping).
+        attr_timeout the number of seconds after which a cached stat
+        object is checked against the underlying filesystem (None to
+        never check).
+        listing_timeout the number of seconds after which a cached
+        directory listing is checked against the underlying filesystem
+        (None to never check).
+        max_stale the number of seconds past attr_timeout and
+        listing_timeout during which cached stat objects and listings
+        are still returned, while being checked in the background.
+        refresh_threads the number of threads doing these checks.
+        max_refresh the number of checks which can be queued.
+        negative_timeout the number of seconds during which a path not
+        found on the underlying filesystem is reported missing without
+        looking it up again (None to always look it up).
+        max_missing the number of missing paths remembered.
+        max_trace_spans the number of spans kept by tracer once tracing
+        is enabled.
         """
         self.cachedir = cachedir
         self.underlying_fs = underlying_fs
@@ -292,165 +559,1126 @@ class Cacher(object):
         # requests are made for data that does not exist in the cache
         self.cache_only_mode = False
 
+        # Ranges of each file, least recently used first, and the paths
+        # whose Ranges were modified since they were last written
+        self.cached_blocks = OrderedDict()
+        self.dirty_blocks = set()
+        self.max_cached_blocks = max_cached_blocks
+        self.blocks_lock = threading.RLock()
+
+        # Number of times Ranges were removed, which tells whether those
+        # loaded without holding blocks_lock may have been removed since
+        self.removals = 0
+
+        # Range objects being fetched from the underlying filesystem for
+        # each path, with the Event set once they are cached, so that
+        # concurrent readers of the same blocks wait instead of fetching
+        # them again
+        self.fetches = {}
+
+        # Serializes changes to the cache files of each path
+        self.path_locks = PathLocks()
+
+        # Paths whose cache.data is known to exist
+        self.data_paths = set()
+
+        # cache.data files are kept open between reads and writes
+        self.cache_data_files = FilePool(os.O_RDWR)
+
+        # and the most recently read ones are mapped, if enabled
+        self.mapped_files = MappedFiles(max_mapped_files) if max_mapped_files else None
+
+        # Number of open FUSE file handles for each path
+        self.open_files = {}
+
+        self.flush_interval = flush_interval
+        self.flush_timer = None
+
+        self.block_size = block_size
+
+        # For each path being read, offset at which the next read
+        # starts if it is sequential and current read-ahead window
+        self.max_readahead = max_readahead
+        self.read_streams = {}
+
+        # Disk usage of the cached files, and the thread keeping it under
+        # max_cache_size, woken up by cache_size_exceeded
+        self.cache_index = CacheIndex()
+        self.max_cache_size = max_cache_size
+        self.cache_size_exceeded = threading.Event()
+        self.evict_thread = None
+
+        # (stat object, time it was last checked) of recently used
+        # paths, and time each recently used listing was last checked
+        self.stats = LRUCache(max_cached_stats)
+        self.listings_checked = LRUCache(max_cached_stats)
+        self.attr_timeout = attr_timeout
+        self.listing_timeout = listing_timeout
+
+        # Checks of stale stat objects and listings, as (function, path).
+        # Those queued or running are in refreshing, so that each is
+        # only queued once.
+        self.max_stale = max_stale
+        self.refresh_queue = Queue.Queue(max_refresh)
+        self.refresh_thread_count = refresh_threads
+        self.refresh_threads = []
+        self.refreshing = set()
+        self.refresh_lock = threading.Lock()
+
+        # Time at which recently looked up paths were found missing
+        self.missing = LRUCache(max_missing)
+        self.negative_timeout = negative_timeout
+
+        # Background writes and read-ahead, as (function, args). Tasks
+        # are only queued while write_threads are running, write_lock
+        # makes sure none is queued after they have been asked to stop.
+        self.write_queue = Queue.Queue(max_write_behind)
+        self.write_thread_count = write_threads
+        self.write_threads = []
+        self.write_lock = threading.Lock()
+
+        self.metrics = Metrics()
+        self.tracer = Tracer(max_trace_spans)
 
         if not os.path.exists(self.cachedir):
             self._mkdir(self.cachedir)
 
+        if metadata == 'sqlite':
+            self.metadata = SqliteMetadataStore(self.cachedir)
+        else:
+            self.metadata = FileMetadataStore(self.cachedir)
+
     def cache_only_mode_enable(self):
-        debug('Cacher.cache_only_mode_enable')
+        log.debug('Cacher.cache_only_mode_enable')
         self.cache_only_mode = True
 
     def cache_only_mode_disable(self):
-        debug('Cacher.cache_only_mode_disable')
+        log.debug('Cacher.cache_only_mode_disable')
         self.cache_only_mode = False
 
+    def start(self):
+        """Start writing modified Ranges to disk periodically and evicting old data."""
+        log.debug('Cacher.start')
+        with self.blocks_lock:
+            self._schedule_flush()
+
+        self.evict_thread = threading.Thread(target=self._evict_cache_loop, name='pcachefs-evict')
+        self.evict_thread.daemon = True
+        self.evict_thread.start()
+
+        with self.write_lock:
+            for _ in range(self.write_thread_count):
+                thread = threading.Thread(target=self._write_behind_loop, name='pcachefs-write')
+                thread.daemon = True
+                thread.start()
+                self.write_threads.append(thread)
+
+        with self.refresh_lock:
+            for _ in range(self.refresh_thread_count):
+                thread = threading.Thread(target=self._refresh_loop, name='pcachefs-refresh')
+                thread.daemon = True
+                thread.start()
+                self.refresh_threads.append(thread)
+
+    def stop(self):
+        """Stop background work and write all modified Ranges to disk."""
+        log.debug('Cacher.stop')
+
+        # Checks may wait for fetches done by the write threads, so stop
+        # them first
+        with self.refresh_lock:
+            refresh_threads, self.refresh_threads = self.refresh_threads, []
+        for _ in refresh_threads:
+            self.refresh_queue.put(None)
+        for thread in refresh_threads:
+            thread.join()
+
+        # Let the write threads finish what is queued first
+        with self.write_lock:
+            write_threads, self.write_threads = self.write_threads, []
+            for _ in write_threads:
+                self.write_queue.put(None)
+        for thread in write_threads:
+            thread.join()
+
+        with self.blocks_lock:
+            flush_timer, self.flush_timer = self.flush_timer, None
+        if flush_timer is not None:
+            flush_timer.cancel()
+            flush_timer.join()
+
+        if self.evict_thread is not None:
+            evict_thread, self.evict_thread = self.evict_thread, None
+            self.cache_size_exceeded.set()
+            evict_thread.join()
+
+        self.flush_cached_blocks()
+        self.metadata.close()
+        self.cache_data_files.close_all()
+        if self.mapped_files is not None:
+            self.mapped_files.close_all()
+
+    def _schedule_flush(self):
+        if not self.flush_interval:
+            return
+
+        self.flush_timer = threading.Timer(self.flush_interval, self._periodic_flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+
+    def _periodic_flush(self):
+        self.flush_cached_blocks()
+        self.metadata.commit()
+
+        with self.blocks_lock:
+            # stop() may have been called while we were flushing
+            if self.flush_timer is not None:
+                self._schedule_flush()
+
     def get_cached_blocks(self, path):
-        data_cache_range = self._get_cache_dir(path, 'cache.data.range')
+        """Return the Ranges of path, loading them from the metadata store if needed.
 
-        cached_blocks = None
-        if os.path.exists(data_cache_range):
-            with __builtin__.open(data_cache_range, 'rb') as f:
-                cached_blocks = pickle.load(f)
-        else:
-            cached_blocks = Ranges()
+        Must not be called with blocks_lock held, since they are loaded
+        without holding it.
+        """
+        with self.blocks_lock:
+            cached_blocks = self._touch_cached_blocks(path)
+        if cached_blocks is not None:
+            return cached_blocks
+
+        with self.path_locks.locked(path):
+            with self.blocks_lock:
+                # loaded by another thread meanwhile
+                cached_blocks = self._touch_cached_blocks(path)
+
+            if cached_blocks is None:
+                loaded = self._load_cached_blocks(path)
+                with self.blocks_lock:
+                    # update_cached_blocks() may have been called meanwhile
+                    cached_blocks = self._touch_cached_blocks(path)
+                    if cached_blocks is None:
+                        cached_blocks = self.cached_blocks[path] = loaded
+
+        self._evict_cached_blocks()
+        return cached_blocks
+
+    def _touch_cached_blocks(self, path):
+        """Return the Ranges of path if they are in memory, making them the most recently used.
 
+        Must be called with blocks_lock held.
+        """
+        cached_blocks = self.cached_blocks.pop(path, None)
+        if cached_blocks is not None:
+            self.cached_blocks[path] = cached_blocks
         return cached_blocks
 
+    @contextmanager
+    def _locked_cached_blocks(self, path):
+        """Hold blocks_lock and yield the Ranges of path, which are loaded beforehand if needed."""
+        while True:
+            with self.blocks_lock:
+                removals = self.removals
+            loaded = self.get_cached_blocks(path)
+
+            with self.blocks_lock:
+                cached_blocks = self._touch_cached_blocks(path)
+                if cached_blocks is None and self.removals == removals:
+                    # Evicted in the meantime, which only happens once
+                    # they are written, so they are still current
+                    cached_blocks = self.cached_blocks[path] = loaded
+
+                if cached_blocks is not None:
+                    yield cached_blocks
+                    return
+
     def update_cached_blocks(self, path, cached_blocks):
-        data_cache_range = self._get_cache_dir(path, 'cache.data.range')
+        with self.blocks_lock:
+            self.cached_blocks.pop(path, None)
+            self.cached_blocks[path] = cached_blocks
+            self.dirty_blocks.add(path)
 
-        with __builtin__.open(data_cache_range, 'wb') as f:
-            pickle.dump(cached_blocks, f)
+        self._evict_cached_blocks()
+
+    def add_cached_blocks(self, path, blocks):
+        """Mark the given Range objects of path as cached."""
+        with self._locked_cached_blocks(path) as cached_blocks:
+            cached_blocks.add_ranges(blocks)
+            self.dirty_blocks.add(path)
+
+    def flush_cached_blocks(self, path=None):
+        """Write modified Ranges to disk.
+
+        If path is None, the Ranges of all files are written. Each is
+        written under the lock of its path, blocks_lock only being held
+        while it is serialized.
+        """
+        with self.blocks_lock:
+            if path is None:
+                paths = list(self.dirty_blocks)
+            elif path in self.dirty_blocks:
+                paths = [ path ]
+            else:
+                return
+
+        for p in paths:
+            with self.path_locks.locked(p):
+                with self.blocks_lock:
+                    if p not in self.dirty_blocks:
+                        # written or removed meanwhile
+                        continue
+                    self.dirty_blocks.discard(p)
+                    data = self.cached_blocks[p].serialize()
+
+                self._write_cached_blocks(p, data)
 
     def remove_cached_blocks(self, path):
-        data_cache_range = self._get_cache_dir(path, 'cache.data.range')
+        with self.path_locks.locked(path):
+            with self.blocks_lock:
+                self._forget_cached_blocks(path)
+            self.metadata.remove_coverage(path)
+
+    def _forget_cached_blocks(self, path):
+        """Drop the Ranges of path from memory. Must be called with blocks_lock held."""
+        self.cached_blocks.pop(path, None)
+        self.dirty_blocks.discard(path)
+        self.removals += 1
+
+    def _new_cached_blocks(self):
+        if self.block_size is None:
+            return Ranges()
+        return BlockBitmap(self.block_size)
+
+    @traced('Cacher._load_cached_blocks')
+    def _load_cached_blocks(self, path):
+        data = self.metadata.get_coverage(path)
+        if data is None:
+            return self._new_cached_blocks()
+
+        try:
+            cached_blocks = ranges.deserialize(data)
+            outdated = False
+        except ValueError:
+            # Written by an older version as a pickle
+            cached_blocks = pickle.loads(data)
+            outdated = True
+
+        # The cache may have been filled with another --block-size
+        if self.block_size is None:
+            outdated = outdated or not isinstance(cached_blocks, Ranges)
+        else:
+            outdated = outdated or not isinstance(cached_blocks, BlockBitmap) \
+                or cached_blocks.block_size != self.block_size
 
-        os.remove(data_cache_range)
+        if outdated:
+            log.debug('Cacher._load_cached_blocks converting %s', path)
+            cached_blocks = self._new_cached_blocks().add_ranges(cached_blocks.ranges)
+            self._write_cached_blocks(path, cached_blocks.serialize())
 
-    def get_cached_data(self, path, size, offset):
-        cache_data = self._get_cache_dir(path, 'cache.data')
+        return cached_blocks
 
-        result = None
-        with __builtin__.open(cache_data, 'rb') as f:
-            f.seek(offset)
-            result = f.read(size)
+    @traced('Cacher._write_cached_blocks')
+    def _write_cached_blocks(self, path, data):
+        self.metadata.put_coverage(path, data)
 
-        return result
+    def _evict_cached_blocks(self):
+        """Drop least recently used Ranges of closed files until there are at most max_cached_blocks.
 
-    def init_cached_data(self, path):
+        Modified Ranges are written first. Must not be called with
+        blocks_lock or the lock of a path held.
+        """
+        with self.blocks_lock:
+            excess = len(self.cached_blocks) - self.max_cached_blocks
+            if excess <= 0:
+                return
+
+            closed = (p for p in self.cached_blocks if p not in self.open_files)
+            paths = list(itertools.islice(closed, excess))
+
+        for p in paths:
+            with self.path_locks.locked(p):
+                self.flush_cached_blocks(p)
+                with self.blocks_lock:
+                    # unless modified or opened meanwhile
+                    if p not in self.dirty_blocks and p not in self.open_files:
+                        self.cached_blocks.pop(p, None)
+
+    @traced('Cacher.get_cached_data')
+    def get_cached_data(self, path, size, offset, file_size=None):
+        """Read from cache.data of path, up to file_size if given.
+
+        Reads near the end of the file ask for more than cache.data
+        holds, bounding them spares checking whether cache.data grew.
+        """
         cache_data = self._get_cache_dir(path, 'cache.data')
+        if file_size is not None:
+            size = max(0, min(size, file_size - offset))
+
+        if self.mapped_files is not None:
+            data = self.mapped_files.read(cache_data, size, offset)
+            if data is not None:
+                return data
+
+        return self.cache_data_files.read(cache_data, size, offset)
 
-        if os.path.exists(cache_data):
+    def init_cached_data(self, path):
+        if path in self.data_paths:
             return
 
+        cache_data = self._get_cache_dir(path, 'cache.data')
         file_stat = self.getattr(path)
         self._create_cache_dir(path)
 
-        with __builtin__.open(cache_data, 'wb') as f:
-            f.truncate()
-            f.seek(file_stat.st_size - 1)
-            f.write('\0')
+        with self.path_locks.locked(path):
+            if not os.path.exists(cache_data):
+                with __builtin__.open(cache_data, 'wb') as f:
+                    f.truncate(file_stat.st_size)
 
+                self.cache_index.update(path, 0)
+
+            # Under the lock so that it cannot be removed meanwhile
+            self.data_paths.add(path)
+
+    @traced('Cacher.update_cached_data')
     def update_cached_data(self, path, blocks_to_read):
+        """Fetch the given blocks from the underlying filesystem into cache.data.
+
+        The data is copied directly into cache.data when possible.
+        """
         if not blocks_to_read:
             return
 
         cache_data = self._get_cache_dir(path, 'cache.data')
+        copy = getattr(self.underlying_fs, 'copy', None)
+
+        # Loop through all the blocks we need to get. No lock is held
+        # while fetching so that other reads of this file are not
+        # delayed by the underlying filesystem.
+        for block in blocks_to_read:
+            start = time.time()
+            with self.tracer.span('Cacher.update_cached_data.block', path=path, offset=block.start, size=block.size):
+                if copy is not None:
+                    size = copy(path, block.size, block.start, self.cache_data_files, cache_data)
+                else:
+                    block_data = self.underlying_fs.read(path, block.size, block.start)
+                    self.cache_data_files.write(cache_data, block_data, block.start)
+                    size = len(block_data)
+
+            self.metrics.observe('fetch', time.time() - start)
+            self.metrics.inc('remote_bytes', size)
+            self._update_cache_size(path, cache_data)
+
+    @traced('Cacher._store_fetched_data')
+    def _store_fetched_data(self, path, fetched, done):
+        """Write data fetched for a read into cache.data and mark it as cached.
+
+        fetched is a list of (Range, data).
+        """
+        try:
+            cache_data = self._get_cache_dir(path, 'cache.data')
+            for block, block_data in fetched:
+                self.cache_data_files.write(cache_data, block_data, block.start)
+            self._update_cache_size(path, cache_data)
+
+            self.add_cached_blocks(path, [block for block, _ in fetched])
+        finally:
+            self._end_fetches(path, done)
+
+    @traced('Cacher._fetch_ahead')
+    def _fetch_ahead(self, path, blocks, done):
+        """Fetch read-ahead blocks into cache.data and mark them as cached."""
+        try:
+            self.update_cached_data(path, blocks)
+            self.add_cached_blocks(path, blocks)
+        finally:
+            self._end_fetches(path, done)
+
+    def _write_behind(self, function, *args):
+        """Call function in a write thread if they are running, or right away.
+
+        Failures are logged either way, the caller does not see them.
+        """
+        with self.write_lock:
+            if self.write_threads:
+                # blocks while the queue is full
+                self.write_queue.put((function, args))
+                return
 
-        # Now open it up in update mode so we can add data to it as
-        # we read the data from the underlying filesystem
-        with __builtin__.open(cache_data, 'r+b') as cache_data_file:
+        self._run_write_behind(function, args)
+
+    def _write_behind_loop(self):
+        while True:
+            task = self.write_queue.get()
+            if task is None:
+                return
 
-            # Now loop through all the blocks we need to get
-            # and append them to the cached file as we go
-            for block in blocks_to_read:
-                block_data = self.underlying_fs.read(path, block.size, block.start)
+            self._run_write_behind(*task)
+
+    def _run_write_behind(self, function, args):  # pylint: disable=no-self-use
+        try:
+            function(*args)
+        except Exception as e:  # pylint: disable=broad-except
+            # The data will be fetched again when it is next read
+            log.warning('Cacher._write_behind %s failed for %s: %s', function.__name__, args[0], e)
+
+    @traced('Cacher.invalidate_cached_data')
+    def invalidate_cached_data(self, path):
+        """Remove the cached data of path, once fetches in progress are done.
+
+        Unlike remove_cached_data(), this can be called while path is
+        being read.
+        """
+        data_cache = self._get_cache_dir(path, 'cache.data')
 
-                cache_data_file.seek(block.start)
-                cache_data_file.write(block_data) # overwrites existing data in the file
+        while True:
+            with self.path_locks.locked(path):
+                with self.blocks_lock:
+                    fetches = self.fetches.get(path)
+                    if not fetches:
+                        # No fetch can start until the lock of path is
+                        # released, since the Ranges must be loaded first
+                        self._forget_cached_blocks(path)
+                        self.read_streams.pop(path, None)
+
+                if not fetches:
+                    if os.path.exists(data_cache):
+                        self._delete_cached_data(path)
+                    self.metadata.remove_coverage(path)
+                    break
+
+            # Data of the old version of the file could be written
+            # after its removal
+            for _, done in fetches:
+                done.wait()
+
+        release = getattr(self.underlying_fs, 'release', None)
+        if release is not None:
+            # the file may have been replaced
+            release(path)
 
     def remove_cached_data(self, path):
+        with self.path_locks.locked(path):
+            with self.blocks_lock:
+                self._forget_cached_blocks(path)
+            self._delete_cached_data(path)
+            self.metadata.remove_coverage(path)
+
+    def _delete_cached_data(self, path):
+        """Delete cache.data of path. Must be called with the lock of path held."""
         data_cache = self._get_cache_dir(path, 'cache.data')
+        self.data_paths.discard(path)
+        self.cache_data_files.close(data_cache)
+        if self.mapped_files is not None:
+            self.mapped_files.close(data_cache)
         os.remove(data_cache)
+        self.cache_index.remove(path)
+
+    def _update_cache_size(self, path, cache_data):
+        """Record the disk usage of cache_data, counted like by the list_data() method of metadata stores."""
+        try:
+            self.cache_index.update(path, os.stat(cache_data).st_blocks * 512)
+        except OSError:
+            # removed in the meantime
+            return
+
+        if self.max_cache_size is not None and self.cache_index.total > self.max_cache_size:
+            self.cache_size_exceeded.set()
+
+    def _evict_cache_loop(self):
+        # Files cached before we started are only known once the cache
+        # directory has been scanned, which can take a while
+        self.cache_index.load(self.metadata.list_data())
+
+        if self.max_cache_size is None:
+            return
+
+        while self.evict_thread is not None:
+            if self.cache_index.total > self.max_cache_size:
+                self.evict_cache(int(self.max_cache_size * 0.9))
+
+            self.cache_size_exceeded.wait()
+            self.cache_size_exceeded.clear()
 
-        data_cache_range = self._get_cache_dir(path, 'cache.data.range')
-        os.remove(data_cache_range)
+    def evict_cache(self, max_size):
+        """Remove data of least recently used files until the cache is at most max_size bytes.
 
+        Files which are open or being fetched are left alone.
+        """
+        log.debug('Cacher.evict_cache %s %s', max_size, self.cache_index.total)
+        for path in self.cache_index.least_recently_used():
+            if self.cache_index.total <= max_size:
+                break
+
+            with self.path_locks.locked(path):
+                with self.blocks_lock:
+                    if path in self.open_files or path in self.fetches:
+                        continue
+                    self._forget_cached_blocks(path)
+
+                size = self.cache_index.size(path)
+                try:
+                    self._delete_cached_data(path)
+                    evicted = True
+                except OSError:
+                    # already removed
+                    self.cache_index.remove(path)
+                    evicted = False
+                self.metadata.remove_coverage(path)
+
+            if evicted:
+                self.metrics.inc('evictions')
+                self.metrics.inc('evicted_bytes', size)
+
+    @traced('Cacher.read')
     def read(self, path, size, offset, force_reload=False):
         """Read the given data from the given path on the filesystem.
 
         Any parts which are requested and are not in the cache are read
         from the underlying filesystem
         """
-        debug('Cacher.read', path, size, offset)
+        log.debug('Cacher.read %s %s %s', path, size, offset)
+
+        # Looked up first, since checking the stat object may
+        # invalidate the cached data
+        file_size = self.getattr(path).st_size
 
         self.init_cached_data(path)
+        self.cache_index.touch(path)
 
         if force_reload:
             self.remove_cached_blocks(path)
 
-        cached_blocks = self.get_cached_blocks(path)
-        blocks_to_read = cached_blocks.get_uncovered_portions(Range(offset, offset+size))
+        readahead = self._get_readahead(path, size, offset)
+
+        wanted = Range(offset, offset+size)
+        fetched = []
+        missed = None
+
+        while True:
+            with self._locked_cached_blocks(path) as cached_blocks:
+                blocks_to_read = cached_blocks.get_uncovered_portions(wanted)
+                if missed is None:
+                    missed = sum(min(b.end, wanted.end) - max(b.start, wanted.start) for b in blocks_to_read)
+
+                if blocks_to_read and readahead:
+                    # We have to go to the underlying filesystem anyway,
+                    # so also fetch what a sequential reader will ask
+                    # for next
+                    end = max(offset + size, min(offset + size + readahead, file_size))
+                    blocks_to_read = cached_blocks.get_uncovered_portions(Range(offset, end))
+
+                if not blocks_to_read:
+                    break
+
+                blocks_to_fetch, waiting = self._find_fetches(path, blocks_to_read, wanted)
+
+                # Blocks we need to answer are fetched right away, the
+                # others are read-ahead
+                blocks_now, blocks_ahead = self._split_fetches(blocks_to_fetch, wanted)
+                now_done = self._start_fetches(path, blocks_now)
+                ahead_done = self._start_fetches(path, blocks_ahead)
+
+            # Fetches not handed to _write_behind() yet, which must be
+            # ended here if anything fails
+            pending = [now_done, ahead_done]
+            try:
+                now_fetched = [(b, self._fetch_block(path, b)) for b in blocks_now]
+                fetched.extend((b.start, block_data) for b, block_data in now_fetched)
+
+                pending.remove(now_done)
+                self._write_behind(self._store_fetched_data, path, now_fetched, now_done)
+                pending.remove(ahead_done)
+                self._write_behind(self._fetch_ahead, path, blocks_ahead, ahead_done)
+            except BaseException:
+                for done in pending:
+                    self._end_fetches(path, done)
+                raise
+
+            if not waiting:
+                break
+
+            # Check again once the other fetches are over, in case one
+            # of them failed
+            with self.tracer.span('Cacher.read.wait', path=path):
+                for event in waiting:
+                    event.wait()
+
+        data = self._assemble_data(path, wanted, fetched, file_size)
+        # Bytes past the end of the file were neither hit nor missed
+        missed = min(missed, len(data))
+        self.metrics.inc('read_bytes', len(data))
+        self.metrics.inc('read_hit_bytes', len(data) - missed)
+        self.metrics.inc('read_miss_bytes', missed)
+        return data
+
+    @traced('Cacher._fetch_block')
+    def _fetch_block(self, path, block):
+        """Read the Range block of path from the underlying filesystem."""
+        start = time.time()
+        data = self.underlying_fs.read(path, block.size, block.start)
+        self.metrics.observe('fetch', time.time() - start)
+        self.metrics.inc('remote_bytes', len(data))
+        return data
+
+    def get_metrics(self):
+        """Return the MetricsShard of all counters and histograms, and a dict of gauges."""
+        snapshot = self.metrics.snapshot()
+        snapshot.counters['stat_cache_hits'] = self.stats.hits
+        snapshot.counters['stat_cache_misses'] = self.stats.misses
+
+        hits = snapshot.counters.get('read_hit_bytes', 0)
+        reads = hits + snapshot.counters.get('read_miss_bytes', 0)
+        gauges = {
+            'cache_size_bytes': self.cache_index.total,
+            'cached_files': len(self.cache_index),
+            'read_hit_ratio': hits / float(reads) if reads else 0.0,
+        }
+        return snapshot, gauges
+
+    def _assemble_data(self, path, wanted, fetched, file_size):
+        """Return the data of the Range wanted of path.
+
+        fetched is a list of (offset, data) just fetched from the
+        underlying filesystem, the rest is read from cache.data, which
+        holds file_size bytes.
+        """
+        pieces = []
+        position = wanted.start
+
+        for start, data in sorted(fetched):
+            end = min(wanted.end, start + len(data))
+            if end <= position:
+                continue
+
+            if start > position:
+                pieces.append(self.get_cached_data(path, start - position, position, file_size))
+                position = start
+
+            if position == start and end == start + len(data):
+                pieces.append(data)
+            else:
+                pieces.append(data[position - start:end - start])
+            position = end
+
+        if position < wanted.end:
+            pieces.append(self.get_cached_data(path, wanted.end - position, position, file_size))
+
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(pieces)
+
+    @traced('Cacher._find_fetches')
+    def _find_fetches(self, path, blocks_to_read, wanted):
+        """Split blocks_to_read between blocks to fetch and blocks already being fetched.
+
+        Must be called with blocks_lock held. Returns the Range objects
+        nobody is fetching yet and the Events of the fetches overlapping
+        the Range wanted, which the caller must wait for.
+        """
+        in_flight = self.fetches.get(path, [])
+        busy = Ranges().add_ranges(r for r, _ in in_flight)
+
+        blocks_to_fetch = []
+        for block in blocks_to_read:
+            blocks_to_fetch.extend(busy.get_uncovered_portions(block))
+
+        waiting = set(e for r, e in in_flight if r.start < wanted.end and wanted.start < r.end)
+
+        return blocks_to_fetch, waiting
 
-        self.update_cached_data(path, blocks_to_read)
-        self.update_cached_blocks(path, cached_blocks.add_ranges(blocks_to_read))
+    def _split_fetches(self, blocks, wanted):
+        """Split blocks between the parts overlapping the Range wanted and the others.
+
+        Blocks are cut at the boundaries of wanted, rounded to whole
+        blocks if block_size is set. Returns (overlapping, others).
+        """
+        align = self.block_size or 1
+        start = wanted.start - wanted.start % align
+        end = wanted.end + (-wanted.end) % align
+
+        overlapping = []
+        others = []
+        for block in blocks:
+            middle_start = min(max(block.start, start), block.end)
+            middle_end = max(min(block.end, end), middle_start)
+            if block.start < middle_start:
+                others.append(Range(block.start, middle_start))
+            if middle_start < middle_end:
+                overlapping.append(Range(middle_start, middle_end))
+            if middle_end < block.end:
+                others.append(Range(middle_end, block.end))
+
+        return overlapping, others
+
+    def _start_fetches(self, path, blocks):
+        """Register the fetch of blocks, return the Event to give to _end_fetches() once done.
+
+        Must be called with blocks_lock held.
+        """
+        done = threading.Event()
+        if blocks:
+            self.fetches.setdefault(path, []).extend((r, done) for r in blocks)
+        return done
+
+    def _end_fetches(self, path, done):
+        """Unregister the fetches started by _start_fetches() and wake up their waiters."""
+        with self.blocks_lock:
+            in_flight = [(r, e) for r, e in self.fetches.get(path, []) if e is not done]
+            if in_flight:
+                self.fetches[path] = in_flight
+            else:
+                self.fetches.pop(path, None)
+
+        done.set()
+
+    def _get_readahead(self, path, size, offset):
+        """Return how many bytes should be fetched past the end of this read.
+
+        The read-ahead window starts at the size of the first read
+        following directly the previous one and doubles with each
+        subsequent sequential read, up to max_readahead. Any
+        non-sequential read resets it.
+        """
+        if not self.max_readahead:
+            return 0
 
-        return self.get_cached_data(path, size, offset)
+        with self.blocks_lock:
+            next_offset, window = self.read_streams.get(path, (None, 0))
 
+            if offset == next_offset:
+                window = min(max(2 * window, size), self.max_readahead)
+            else:
+                window = 0
+
+            self.read_streams[path] = (offset + size, window)
+
+        return window
+
+    @traced('Cacher.prefetch')
+    def prefetch(self, path, chunk_size=4 * 1024 * 1024, throttle=None, force_reload=False):
+        """Fetch the data of path which is not cached yet, chunk_size bytes at a time.
+
+        throttle, if given, is called with the size of each chunk before
+        it is fetched. If force_reload is True, the data already cached
+        is fetched again. Returns the number of bytes fetched.
+        """
+        log.debug('Cacher.prefetch %s', path)
+        self.open(path, os.O_RDONLY)
+        try:
+            if force_reload:
+                self.remove_cached_blocks(path)
+
+            size = self.getattr(path).st_size
+            self.init_cached_data(path)
+
+            fetched = 0
+            if size == 0:
+                return fetched
+
+            if self.block_size is not None:
+                # chunks must be made of whole blocks
+                chunk_size += -chunk_size % self.block_size
+
+            for block in self.get_cached_blocks(path).get_uncovered_portions(Range(0, size)):
+                for offset in xrange(block.start, min(block.end, size), chunk_size):
+                    chunk = Range(offset, min(offset + chunk_size, block.end))
+                    if throttle is not None:
+                        throttle(min(chunk.end, size) - offset)
+                    fetched += self._fill(path, chunk, size)
+
+            return fetched
+        finally:
+            self.release(path, os.O_RDONLY)
+
+    def _fill(self, path, chunk, size):
+        """Fetch the parts of the Range chunk of path which are neither cached nor being fetched.
+
+        Returns the number of bytes fetched, those past size excluded.
+        """
+        with self._locked_cached_blocks(path) as cached_blocks:
+            blocks = cached_blocks.get_uncovered_portions(chunk)
+            blocks, _ = self._find_fetches(path, blocks, chunk)
+            done = self._start_fetches(path, blocks)
+
+        try:
+            self.update_cached_data(path, blocks)
+            self.add_cached_blocks(path, blocks)
+        finally:
+            self._end_fetches(path, done)
+
+        return sum(min(block.end, size) - block.start for block in blocks if block.start < size)
+
+    @traced('Cacher.open')
+    def open(self, path, flags):
+        log.debug('Cacher.open %s %s', path, flags)
+
+        # Make sure the cached data is still valid
+        self.getattr(path)
+
+        with self.blocks_lock:
+            self.open_files[path] = self.open_files.get(path, 0) + 1
+
+        return 0
+
+    def flush(self, path):
+        log.debug('Cacher.flush %s', path)
+        self.flush_cached_blocks(path)
+
+        return 0
 
+    @traced('Cacher.release')
+    def release(self, path, flags):
+        log.debug('Cacher.release %s %s', path, flags)
+        with self.blocks_lock:
+            count = self.open_files.pop(path, 0) - 1
+            if count > 0:
+                self.open_files[path] = count
+            else:
+                self.read_streams.pop(path, None)
+
+        self.flush_cached_blocks(path)
+        self._evict_cached_blocks()
+
+        if count <= 0:
+            self.cache_data_files.close(self._get_cache_dir(path, 'cache.data'))
+            self.underlying_fs.release(path)
+
+            # Lets the CacheIndex know when the file was last used after
+            # a restart
+            self.metadata.touch_data(path)
+
+        return 0
+
+
+    @traced('Cacher.readdir')
     def readdir(self, path, offset):
-        """List the given directory, from the cache."""
-        debug('Cacher.readdir', path, offset)
-        cache_dir = self._get_cache_dir(path, 'cache.list')
+        """List the given directory from the offset-th entry, from the cache.
+
+        The offset of each Direntry returned is that of the next one, so
+        that the kernel can list large directories in several calls.
+        """
+        log.debug('Cacher.readdir %s %s', path, offset)
+        now = time.time()
+        result = self.metadata.get_listing(path, offset)
+
+        if result is not None and self.listing_timeout is not None:
+            checked = self.listings_checked.get(path)
+            if checked is None or now - checked >= self.listing_timeout:
+                if not self._is_servable_stale(checked, self.listing_timeout, now) \
+                        or not self._refresh_later(self._check_listing, path):
+                    result = self._check_listing(path, now, offset)
+        elif result is None:
+            result = self._list(path, now, offset)
+
+        return (fuse.Direntry(name, type=type, offset=index + 1)
+                for index, (name, type) in enumerate(result, offset))
+
+    @traced('Cacher._check_listing')
+    def _check_listing(self, path, now, offset=0):
+        """Make sure the cached listing of path is up to date, and return it from the offset-th entry."""
+        # removes the listing if the directory changed
+        self._check_stat(path, now)
+
+        result = self.metadata.get_listing(path, offset)
+        if result is None:
+            return self._list(path, now, offset)
+
+        self.listings_checked.put(path, now)
+        return result
+
+    @traced('Cacher._list')
+    def _list(self, path, now, offset=0):
+        """List path on the underlying filesystem, cache the listing and return it from the offset-th entry.
 
-        result = None
-        if os.path.exists(cache_dir):
-            with __builtin__.open(cache_dir, 'rb') as list_cache_file:
-                result = pickle.load(list_cache_file)
+        The listing is returned as (name, type) like by metadata stores.
+        """
+        if self.listing_timeout is not None:
+            # the listing is later checked against this stat object
+            self.getattr(path)
 
+        readdir_stats = getattr(self.underlying_fs, 'readdir_stats', None)
+        if readdir_stats is None:
+            result = list(self.underlying_fs.readdir(path, 0))
         else:
-            result_generator = self.underlying_fs.readdir(path, offset)
-            result = list(result_generator)
+            result, stats = readdir_stats(path)
+            self._put_listed_stats(path, stats, now)
+
+        result = [(entry.name, entry.type) for entry in result]
+        self.metadata.put_listing(path, result)
+
+        if self.negative_timeout is not None:
+            # entries created since they were found missing
+            for name, _ in result:
+                self.missing.pop(os.path.join(path, name))
+
+        if self.listing_timeout is not None:
+            self.listings_checked.put(path, now)
+
+        return itertools.islice(result, offset, None)
+
+    def _put_listed_stats(self, path, stats, now):
+        """Cache the stat objects of the entries of path, got while listing it.
+
+        stats is a list of (name, stat object). Those already cached are
+        only replaced if they are checked against the underlying
+        filesystem anyway, that is if attr_timeout is given.
+        """
+        changed = []
+        for name, result in stats:
+            entry_path = os.path.join(path, name)
+            cached = self.stats.get(entry_path)
+            cached = self.metadata.get_stat(entry_path) if cached is None else cached[0]
+
+            if cached is not None:
+                if self.attr_timeout is None:
+                    continue
+                self._remove_changed(entry_path, cached, result)
 
-            self._create_cache_dir(path)
-            with __builtin__.open(cache_dir, 'wb') as list_cache_file:
-                pickle.dump(result, list_cache_file)
+            if cached is None or vars(cached) != vars(result):
+                changed.append((entry_path, result))
+            self.stats.put(entry_path, (result, now))
 
-        # Return a new generator over our list of items
-        return (x for x in result)
+        self.metadata.put_stats(changed)
 
+    @traced('Cacher.getattr')
     def getattr(self, path):
         """Retrieve stat information for a particular file from the cache."""
-        debug('Cacher.getattr', path)
-        cache_dir = self._get_cache_dir(path, 'cache.stat')
-
-        result = None
-        if os.path.exists(cache_dir):
-            with __builtin__.open(cache_dir, 'rb') as stat_cache_file:
-                result = pickle.load(stat_cache_file)
+        log.debug('Cacher.getattr %s', path)
+        now = time.time()
+
+        if self.negative_timeout is not None:
+            missing = self.missing.get(path)
+            if missing is not None:
+                if now - missing < self.negative_timeout:
+                    raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+                self.missing.pop(path)
+
+        cached = self.stats.get(path)
+        if cached is not None:
+            result, checked = cached
+            if self.attr_timeout is None or now - checked < self.attr_timeout:
+                return result
+
+            if self._is_servable_stale(checked, self.attr_timeout, now) \
+                    and self._refresh_later(self._check_stat, path):
+                return result
+
+            return self._check_stat(path, now)
+
+        result = self.metadata.get_stat(path)
+
+        if result is None:
+            result = self._underlying_getattr(path, now)
+            self.metadata.put_stat(path, result)
+        elif self.attr_timeout is not None:
+            # we do not know when it was last checked
+            return self._check_stat(path, now)
+
+        self.stats.put(path, (result, now))
+        return result
 
-        else:
-            result = self.underlying_fs.getattr(path)
+    @traced('Cacher._check_stat')
+    def _check_stat(self, path, now):
+        """Compare the cached stat object of path with the underlying filesystem.
 
-            self._create_cache_dir(path)
-            with __builtin__.open(cache_dir, 'wb') as stat_cache_file:
-                pickle.dump(result, stat_cache_file)
+        If the modification time or size of path changed, its cached
+        data or listing is removed. Returns the new stat object.
 
+        If the underlying filesystem fails for another reason than path
+        not existing anymore, the cached stat object is returned and
+        checked again next time.
+        """
+        cached = self.metadata.get_stat(path)
+        try:
+            result = self._underlying_getattr(path, now)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                if cached is None:
+                    raise
+                log.warning('Cacher._check_stat failed for %s, using the cached stat object: %s', path, e)
+                return cached
+
+            log.info('%s removed from the underlying filesystem, removing it from the cache', path)
+            self.stats.pop(path)
+            self.metadata.remove_stat(path)
+            self.metadata.remove_listing(path)
+            self.invalidate_cached_data(path)
+            raise
+
+        self._remove_changed(path, cached, result)
+
+        if cached is None or vars(cached) != vars(result):
+            self.metadata.put_stat(path, result)
+
+        self.stats.put(path, (result, now))
         return result
 
+    def _remove_changed(self, path, cached, result):
+        """Remove the cached data or listing of path if its stat object changed from cached to result."""
+        if cached is None or cached.st_mtime != result.st_mtime or cached.st_size != result.st_size:
+            log.info('%s changed on the underlying filesystem, removing it from the cache', path)
+            if stat.S_ISDIR(result.st_mode):
+                self.metadata.remove_listing(path)
+            else:
+                self.invalidate_cached_data(path)
+
+    @traced('Cacher._underlying_getattr')
+    def _underlying_getattr(self, path, now):
+        """Call getattr() on the underlying filesystem, remembering missing paths."""
+        try:
+            return self.underlying_fs.getattr(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT and self.negative_timeout is not None:
+                self.missing.put(path, now)
+            raise
+
+    def _is_servable_stale(self, checked, timeout, now):
+        """Tell whether something last checked at checked can be returned while it is checked again."""
+        return checked is not None and now - checked < timeout + self.max_stale
+
+    def _refresh_later(self, function, path):
+        """Call function(path, now) in a refresh thread.
+
+        Returns False if it cannot be queued, because the refresh
+        threads are not running or too many checks are queued already.
+        """
+        with self.refresh_lock:
+            if not self.refresh_threads:
+                return False
+
+            if (function, path) in self.refreshing:
+                return True
+
+            try:
+                self.refresh_queue.put_nowait((function, path))
+            except Queue.Full:
+                return False
+
+            self.refreshing.add((function, path))
+            return True
+
+    def _refresh_loop(self):
+        while True:
+            task = self.refresh_queue.get()
+            if task is None:
+                return
+
+            function, path = task
+            try:
+                function(path, time.time())
+            except Exception as e:  # pylint: disable=broad-except
+                # It will be checked again when next used
+                log.warning('Cacher._refresh_loop %s failed for %s: %s', function.__name__, path, e)
+            finally:
+                with self.refresh_lock:
+                    self.refreshing.discard(task)
+
     def write(self, path, buf, offset):  # pylint: disable=no-self-use
-        debug('Cacher.write', path, buf, offset)
+        log.debug('Cacher.write %s %d bytes at %d', path, len(buf), offset)
         return E_NOT_IMPL
 
     def _get_cache_dir(self, path, file = None):
         """For a given path, return the name of the directory used to cache data for that path."""
-        if path[0] != '/':
-            raise ValueError("Expected leading slash")
-
-        if file is None:
-            return os.path.join(self.cachedir, path[1:])
-
-        return os.path.join(self.cachedir, path[1:], file)
+        return get_cache_path(self.cachedir, path, file)
 
     def _create_cache_dir(self, path):
         """Create the cache path for the given directory if it does not already exist."""
@@ -459,8 +1687,7 @@ class Cacher(object):
 
     def _mkdir(self, path):  # pylint: disable=no-self-use
         """Create the given directory if it does not already exist."""
-        if not os.path.exists(path):
-            os.makedirs(path)
+        makedirs(path)
 
 
 def main(args=None):
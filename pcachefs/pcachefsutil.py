@@ -2,13 +2,125 @@
 Utility methods used across pcachefs.
 """
 import errno
+import functools
+import itertools
+import logging
 import os
-import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-DEBUG = True
-def debug(*words):
-    if DEBUG:
-        sys.stderr.write('DEBUG: %s\n' % ' '.join(str(word) for word in words))
+
+LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+
+# Nothing is written unless configure_logging() is called
+logging.getLogger('pcachefs').addHandler(logging.NullHandler())
+
+
+def _ignore(*args):  # pylint: disable=unused-argument
+    pass
+
+
+class SubsystemLogger(object):
+    """Logger of a subsystem of pcachefs, see get_logger().
+
+    debug(), info(), warning() and error() take a format string and its
+    arguments, which are only formatted if the message is written. The
+    methods of disabled levels are replaced by a function doing nothing,
+    so that a disabled call costs no more than calling it.
+
+    If sampling is more than 1, only one debug message out of sampling
+    is written.
+    """
+    def __init__(self, name):
+        self.logger = logging.getLogger('pcachefs.' + name)
+        self.sampling = 1
+        self.counter = itertools.count()
+        self.update()
+
+    def update(self):
+        """Replace the methods of the disabled levels, once levels or sampling changed."""
+        for name, level in LOG_LEVELS.items():
+            if not self.logger.isEnabledFor(level):
+                method = _ignore
+            elif level == logging.DEBUG and self.sampling > 1:
+                method = self._sampled_debug
+            else:
+                method = functools.partial(self.logger.log, level)
+            setattr(self, name, method)
+
+    def _sampled_debug(self, message, *args):
+        if next(self.counter) % self.sampling == 0:
+            self.logger.debug(message, *args)
+
+
+_loggers = {}
+def get_logger(name):
+    """Return the SubsystemLogger of the subsystem name (e.g. 'cacher')."""
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers[name] = SubsystemLogger(name)
+    return logger
+
+
+def parse_log_levels(levels):
+    """Parse a level optionally followed by levels of subsystems (e.g. 'warning,cacher=debug').
+
+    Returns (level, {subsystem: level}).
+    """
+    default = logging.WARNING
+    subsystems = {}
+    for item in levels.split(','):
+        name, _, level = item.strip().rpartition('=')
+        if level.lower() not in LOG_LEVELS:
+            raise ValueError('Unknown log level ' + level)
+        if name:
+            subsystems[name] = LOG_LEVELS[level.lower()]
+        else:
+            default = LOG_LEVELS[level.lower()]
+    return default, subsystems
+
+
+def parse_log_sampling(sampling):
+    """Parse the sampling of subsystems (e.g. 'cacher=100,vfs=10') into a dict."""
+    result = {}
+    for item in sampling.split(','):
+        if item.strip():
+            name, _, rate = item.strip().partition('=')
+            result[name] = int(rate)
+            if result[name] < 1:
+                raise ValueError('Invalid sampling ' + item)
+    return result
+
+
+def configure_logging(levels='warning', sampling='', filename=None):
+    """Write log messages to filename, or the standard error.
+
+    levels and sampling are parsed by parse_log_levels() and
+    parse_log_sampling(). Raises ValueError if they are invalid or
+    refer to unknown subsystems.
+    """
+    default, subsystem_levels = parse_log_levels(levels)
+    subsystem_sampling = parse_log_sampling(sampling)
+    for name in set(subsystem_levels) | set(subsystem_sampling):
+        if name not in _loggers:
+            raise ValueError('Unknown subsystem %s, expected one of %s' % (name, ', '.join(sorted(_loggers))))
+
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    root = logging.getLogger('pcachefs')
+    for old in root.handlers:
+        old.close()
+    root.handlers = [handler]
+    root.propagate = False
+    root.setLevel(default)
+
+    for name, logger in _loggers.items():
+        logger.logger.setLevel(subsystem_levels.get(name, logging.NOTSET))
+        logger.sampling = subsystem_sampling.get(name, 1)
+        logger.update()
 
 # Error codes
 # source: /usr/lib/syslinux/com32/include/errno.h
@@ -21,6 +133,124 @@ E_NOT_IMPL= -errno.ENOSYS
 E_INVALID_ARG = -errno.EINVAL
 
 
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+def parse_size(size):
+    """Parse a size in bytes with an optional K, M, G or T suffix (e.g. 1M)."""
+    size = size.strip().upper()
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(size[:-1]) * SIZE_SUFFIXES[size[-1]]
+    return int(size)
+
+
+def format_size(size):
+    """Format a size in bytes with a K, M, G or T suffix (e.g. 1.5M)."""
+    for suffix in 'TGMK':
+        if size >= SIZE_SUFFIXES[suffix]:
+            return '%.1f%s' % (size / float(SIZE_SUFFIXES[suffix]), suffix)
+    return str(size)
+
+
 def is_read_only_flags(flags):
     access_flags = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
     return flags & access_flags == os.O_RDONLY
+
+
+class PathLocks(object):
+    """A lock per path, created on demand and dropped once unused.
+
+    Usage:
+      locks = PathLocks()
+      with locks.locked('/some/path'):
+          ...
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextmanager
+    def locked(self, path):
+        with self.lock:
+            entry = self.locks.get(path)
+            if entry is None:
+                entry = self.locks[path] = [threading.RLock(), 0]
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[path]
+
+
+class LRUCache(object):
+    """A thread-safe dict holding at most max_size items.
+
+    The least recently used items are dropped first. Hits and misses of
+    get() are counted.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            # re-insert so that key becomes the most recently used
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.items.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class RateLimiter(object):
+    """Limits the rate at which several threads consume something, e.g. bytes.
+
+    Usage:
+      limiter = RateLimiter(1024 * 1024)  # per second
+      limiter.consume(len(chunk))  # sleeps as needed before using chunk
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, amount):
+        """Wait until amount can be consumed without going over the rate."""
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + amount / self.rate
+
+        if start > now:
+            time.sleep(start - now)
@@ -0,0 +1,163 @@
+"""
+Background prefetch of whole directory trees by pcachefs.
+"""
+import os
+import Queue
+import stat
+import threading
+
+from pcachefsutil import get_logger
+
+log = get_logger('prefetch')
+
+
+class PrefetchStopped(Exception):
+    """Raised in the worker threads once stop() has been called."""
+    pass
+
+
+class PrefetchStatus(object):
+    """Progress of the prefetch of a directory tree, in bytes.
+
+    queued is the size of the files found but not being fetched yet,
+    in_progress that of those being fetched, and completed that of those
+    done, fetched being how much of it was actually fetched rather than
+    already cached.
+    """
+    def __init__(self):
+        self.queued = 0
+        self.in_progress = 0
+        self.completed = 0
+        self.fetched = 0
+        self.errors = 0
+
+        # (st_dev, st_ino) of the directories listed, against symlink loops
+        self.visited = set()
+
+    def format(self):
+        """Return the status as 'name value' lines, always of the same length."""
+        return ''.join('%-12s%20d\n' % (name, getattr(self, name))
+                       for name in ('queued', 'in_progress', 'completed', 'fetched', 'errors'))
+
+
+class Prefetcher(object):
+    """Fetches directory trees into the cache of a Cacher in the background.
+
+    prefetch() queues a directory and returns right away. The tree is
+    then walked and its files fetched by threads threads, and the
+    progress of each directory queued is available from status().
+
+    Threads are only started by start(), since FUSE forks when going to
+    the background.
+    """
+    def __init__(self, cacher, threads=2, chunk_size=4 * 1024 * 1024):
+        self.cacher = cacher
+        self.thread_count = threads
+        self.chunk_size = chunk_size
+
+        # (PrefetchStatus, path, size of file or None for directories)
+        self.queue = Queue.Queue()
+        self.threads = []
+
+        self.lock = threading.Lock()
+        self.statuses = {}
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.stopped.clear()
+        for _ in range(self.thread_count):
+            thread = threading.Thread(target=self._prefetch_loop, name='pcachefs-prefetch')
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stop the threads once they are done with the chunk they are fetching."""
+        self.stopped.set()
+
+        threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def prefetch(self, path):
+        """Queue the files under the directory path to be fetched."""
+        log.debug('Prefetcher.prefetch %s', path)
+        with self.lock:
+            status = self.statuses[path] = PrefetchStatus()
+        self.queue.put((status, path, None))
+
+    def status(self, path):
+        """Return the PrefetchStatus of the last prefetch of path, or None."""
+        with self.lock:
+            return self.statuses.get(path)
+
+    def _prefetch_loop(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+
+            status, path, size = task
+            if self.stopped.is_set():
+                continue
+
+            try:
+                if size is None:
+                    self._list(status, path)
+                else:
+                    self._fetch(status, path, size)
+            except PrefetchStopped:
+                pass
+            except Exception as e:  # pylint: disable=broad-except
+                log.warning('Prefetcher._prefetch_loop failed for %s: %s', path, e)
+                with self.lock:
+                    status.errors += 1
+
+    def _list(self, status, path):
+        """Queue the entries of the directory path, unless it was already listed."""
+        st = self.cacher.getattr(path)
+        with self.lock:
+            if (st.st_dev, st.st_ino) in status.visited:
+                return
+            status.visited.add((st.st_dev, st.st_ino))
+
+        for entry in self.cacher.readdir(path, 0):
+            if entry.name in ('.', '..'):
+                continue
+
+            entry_path = os.path.join(path, entry.name)
+            try:
+                st = self.cacher.getattr(entry_path)
+            except (IOError, OSError) as e:
+                log.warning('Prefetcher._list failed for %s: %s', entry_path, e)
+                with self.lock:
+                    status.errors += 1
+                continue
+
+            if stat.S_ISDIR(st.st_mode):
+                self.queue.put((status, entry_path, None))
+            elif stat.S_ISREG(st.st_mode):
+                with self.lock:
+                    status.queued += st.st_size
+                self.queue.put((status, entry_path, st.st_size))
+
+    def _fetch(self, status, path, size):
+        with self.lock:
+            status.queued -= size
+            status.in_progress += size
+
+        try:
+            fetched = self.cacher.prefetch(path, self.chunk_size, throttle=self._throttle)
+        finally:
+            with self.lock:
+                status.in_progress -= size
+
+        with self.lock:
+            status.completed += size
+            status.fetched += fetched
+
+    def _throttle(self, _):
+        if self.stopped.is_set():
+            raise PrefetchStopped()
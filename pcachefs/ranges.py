@@ -19,6 +19,26 @@
 
 """
 
+import struct
+from bisect import bisect_left, bisect_right
+
+
+# On-disk format of Ranges: a header made of a magic string, a version
+# number and the number of ranges, followed by the start and end of each
+# range, all little-endian.
+RANGES_MAGIC = 'PCFR'
+RANGES_VERSION = 1
+RANGES_HEADER = struct.Struct('<4sB3xQ')
+
+# On-disk format of BlockBitmap: the same header where the number of
+# ranges is replaced by the block size, followed by the bitmap.
+BITMAP_MAGIC = 'PCFB'
+BITMAP_VERSION = 1
+
+# Number of bits set in each possible byte
+BITS_SET = [bin(b).count('1') for b in range(256)]
+
+
 class Range(object):
     """Represents a range of integers (i.e. a start and an end)."""
     def __init__(self, start, end):
@@ -87,49 +107,96 @@ class Ranges(object):
       # ranges = (0,16)
       # (1,3) is already included in our range so it is effectively
       # ignored
+
+    Internally the ranges are stored as two parallel sorted lists of
+    starts and ends so that lookups are done by bisection and additions
+    are merged in place.
     """
     def __init__(self):
-        self.ranges = []
-
-        # start and end of the entire range (ie the start point of the
-        # starting range to the end point of the finishing range)
-        self.start = 0
-        self.end = 0
+        self.starts = []
+        self.ends = []
 
     def __repr__(self):
         return str(self.ranges)
 
-    def _cleanup(self):
-        old_ranges = list(self.ranges)
-        old_ranges.sort()
+    def serialize(self):
+        """Encode this Ranges in the compact binary on-disk format."""
+        header = RANGES_HEADER.pack(RANGES_MAGIC, RANGES_VERSION, len(self.starts))
 
-        i = 0
-        while i < (len(old_ranges)-1):
-            # get the next item, compare it with the item that follows it
-            item = old_ranges[i]
-            next_item = old_ranges[i+1]
+        bounds = [None] * (2 * len(self.starts))
+        bounds[0::2] = self.starts
+        bounds[1::2] = self.ends
 
-            if item.end >= next_item.start:
-                old_ranges.pop(i)
-                old_ranges.pop(i) # effectively this removes item at i+1
+        return header + struct.pack('<%dQ' % len(bounds), *bounds)
 
-                new_range = Range(item.start, max(item.end, next_item.end))
-                old_ranges.append(new_range)
-                old_ranges.sort()
+    @classmethod
+    def deserialize(cls, data):
+        """Decode a Ranges encoded by serialize().
 
-            else:
-                # only move to the next item of the list if we didn't modify
-                # the current item
-                i += 1
+        Raises ValueError if data is not in the expected format.
+        """
+        if len(data) < RANGES_HEADER.size:
+            raise ValueError('Ranges data too short')
+
+        magic, version, count = RANGES_HEADER.unpack_from(data)
+        if magic != RANGES_MAGIC:
+            raise ValueError('Not a Ranges data')
+        if version != RANGES_VERSION:
+            raise ValueError('Unsupported Ranges version ' + str(version))
+        if len(data) != RANGES_HEADER.size + 16 * count:
+            raise ValueError('Ranges data has wrong size')
+
+        bounds = struct.unpack_from('<%dQ' % (2 * count), data, RANGES_HEADER.size)
+
+        result = cls()
+        result.starts = list(bounds[0::2])
+        result.ends = list(bounds[1::2])
+        return result
+
+    def __getstate__(self):
+        return {'starts': self.starts, 'ends': self.ends}
+
+    def __setstate__(self, state):
+        self.starts = []
+        self.ends = []
+
+        if 'ranges' in state:
+            # pickled by an older version which stored a list of Range
+            for r in state['ranges']:
+                self.add_range(r)
+        else:
+            self.starts = state['starts']
+            self.ends = state['ends']
+
+    @property
+    def ranges(self):
+        return [Range(s, e) for s, e in zip(self.starts, self.ends)]
 
-        self.ranges = old_ranges
+    @property
+    def start(self):
+        """Start point of the first range."""
+        return self.starts[0] if self.starts else 0
 
-        self.start = self.ranges[0].start
-        self.end = self.ranges[-1].end
+    @property
+    def end(self):
+        """End point of the last range."""
+        return self.ends[-1] if self.ends else 0
 
     def add_range(self, range):
-        self.ranges.append(range)
-        self._cleanup()
+        start = range.start
+        end = range.end
+
+        # all ranges from i (included) to j (excluded) overlap or touch
+        # the new range and are merged with it
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end, i)
+
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j-1])
+
+        self.starts[i:j] = [ start ]
+        self.ends[i:j] = [ end ]
         return self
 
     def add_ranges(self, ranges):
@@ -148,17 +215,17 @@ class Ranges(object):
         object (i.e. its start and end are completely 'inside' or equal
         to a Range in this Ranges).
         """
-        for r in self.ranges:
-            if r.contains(i):
-                return True
+        if type(i) == Range:
+            start, end = i.start, i.end
+        else:
+            start, end = i, i
 
-        return False
+        # the only candidate is the last range starting at or before i
+        index = bisect_right(self.starts, start) - 1
+        return index >= 0 and end <= self.ends[index]
 
     def number(self):
-        num = 0
-        for r in self.ranges:
-            num += r.end - r.start
-        return num
+        return sum(self.ends) - sum(self.starts)
 
     def get_uncovered_portions(self, range):
         """Determine which parts of range are not covered by ranges within this Ranges object.
@@ -175,88 +242,177 @@ class Ranges(object):
         """
         portions = []
 
-        # if we have no ranges added then none of the given range will
-        # be covered
-        if not self.ranges:
-            return [ range ]
+        position = range.start
 
-        # if the search range doesn't overlap any items in this range
-        # this nothing in this range will cover any of the search range
-        if range.end <= self.start or range.start >= self.end:
-            return [ range ]
+        # skip all ranges ending before the search range begins
+        i = bisect_right(self.ends, position)
+        while i < len(self.starts) and self.starts[i] < range.end:
+            if self.starts[i] > position:
+                portions.append(Range(position, self.starts[i]))
 
-        search_range = Range(range.start, range.end)
-        i = 0
-        while i < len(self.ranges):
-            item = self.ranges[i]
-
-            if item.contains(search_range):
-                # if search_range is entirely contained, exit loop (return empty list)
+            position = self.ends[i]
+            if position >= range.end:
                 break
 
-            elif not item.contains(search_range.start):
-                # if search_range.start doesn't fall within this item,
-                # either search_range begins before item.start, or after
-                # item.end
-
-                if search_range.start < item.start:
-
-                    if search_range.end < item.start:
-                        # if search_range ends before this item (ie
-                        # never overlaps) then add a portion
-                        # representing the entire search_range and exit
-                        # the loop, since we've now gone as far as the
-                        # end of the search_range
-                        portions.append(Range(search_range.start, search_range.end))
-                        break
-
-                    else:
-                        # if search_range begins before this item starts
-                        # (and it overlaps with this item), add
-                        # a portion to account for the space between
-                        # search_range.start and item.start, move
-                        # beginning of search_range to item.start, and
-                        # re-run loop without moving to the next item
-
-                        portions.append(Range(search_range.start, item.start))
-                        search_range = Range(item.start, search_range.end)
-
-                else:
-                    # if this item does not overlap search range at all,
-                    # ignore this item
-                    i += 1 # move to next item
+            i += 1
+
+        if position < range.end:
+            portions.append(Range(position, range.end))
+
+        return portions
+
 
+class BlockBitmap(object):
+    """Coverage of a file tracked as a bitmap of fixed-size blocks.
+
+    This class has the same interface as Ranges but only ever knows
+    about whole blocks: a block is covered once a range spanning it
+    entirely has been added, and get_uncovered_portions() returns ranges
+    aligned on block boundaries. Checking a block is O(1) and the
+    bitmap takes one bit per block of the file.
+    """
+    def __init__(self, block_size):
+        if block_size <= 0:
+            raise ValueError('block_size (' + str(block_size) + ') must be positive')
+
+        self.block_size = block_size
+        self.bitmap = bytearray()
+
+    def __repr__(self):
+        return 'BlockBitmap ' + str(self.block_size) + ' ' + str(self.ranges)
+
+    def _is_set(self, block):
+        byte = block >> 3
+        return byte < len(self.bitmap) and self.bitmap[byte] & (1 << (block & 7)) != 0
+
+    def _set(self, block):
+        byte = block >> 3
+        if byte >= len(self.bitmap):
+            self.bitmap.extend(bytearray(byte + 1 - len(self.bitmap)))
+        self.bitmap[byte] |= 1 << (block & 7)
+
+    def _blocks_set(self):
+        for byte, value in enumerate(self.bitmap):
+            if value:
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield (byte << 3) + bit
+
+    def serialize(self):
+        """Encode this BlockBitmap in the compact binary on-disk format."""
+        header = RANGES_HEADER.pack(BITMAP_MAGIC, BITMAP_VERSION, self.block_size)
+        return header + str(self.bitmap)
+
+    @classmethod
+    def deserialize(cls, data):
+        """Decode a BlockBitmap encoded by serialize().
+
+        Raises ValueError if data is not in the expected format.
+        """
+        if len(data) < RANGES_HEADER.size:
+            raise ValueError('BlockBitmap data too short')
+
+        magic, version, block_size = RANGES_HEADER.unpack_from(data)
+        if magic != BITMAP_MAGIC:
+            raise ValueError('Not a BlockBitmap data')
+        if version != BITMAP_VERSION:
+            raise ValueError('Unsupported BlockBitmap version ' + str(version))
+
+        result = cls(block_size)
+        result.bitmap = bytearray(data[RANGES_HEADER.size:])
+        return result
+
+    @property
+    def ranges(self):
+        result = []
+        for block in self._blocks_set():
+            start = block * self.block_size
+            if result and result[-1].end == start:
+                result[-1] = Range(result[-1].start, start + self.block_size)
             else:
-                # if overlaps, then move the search_range up to begin at
-                # the end of this item (since it is 'covered' up to the
-                # end of this
-                # item)
-                search_range = Range(item.end, search_range.end)
-
-                # get the next item (because of _cleanup, we know that
-                # there will be space between item and next_item)
-                next_item = None
-                if i < len(self.ranges)-1:
-                    next_item = self.ranges[i+1]
-
-                if next_item is None or search_range.end <= next_item.start:
-                    # if our search_range finishes before we get to the
-                    # next item, then add a portion for search_range,
-                    # and exit (since we've finished)
-
-                    portions.append(Range(search_range.start, search_range.end))
-                    break
-
-                else:
-                    # if our search_range strays into the next_item
-                    # range, add a portion to cover the space up to the
-                    # beginning of the next item, then move the
-                    # beginning of search_range up to the next item and
-                    # re-run loop
-
-                    portions.append(Range(search_range.start, next_item.start))
-                    search_range = Range(next_item.start, search_range.end)
-
-                    i += 1 # move to next item
+                result.append(Range(start, start + self.block_size))
+        return result
+
+    @property
+    def start(self):
+        """Start point of the first covered block."""
+        for block in self._blocks_set():
+            return block * self.block_size
+        return 0
+
+    @property
+    def end(self):
+        """End point of the last covered block."""
+        for byte in reversed(range(len(self.bitmap))):
+            value = self.bitmap[byte]
+            if value:
+                return ((byte << 3) + value.bit_length()) * self.block_size
+        return 0
+
+    def add_range(self, range):
+        # Only blocks which are entirely inside range become covered
+        first = -(-range.start // self.block_size)
+        last = range.end // self.block_size
+
+        for block in xrange(first, last):
+            self._set(block)
+        return self
+
+    def add_ranges(self, ranges):
+        for range in ranges:
+            self.add_range(range)
+        return self
+
+    def contains(self, i):
+        """Determines if i is contained within the covered blocks.
+
+        If i is a Range object, all the blocks it overlaps must be
+        covered.
+        """
+        if type(i) == Range:
+            first, last = i.start // self.block_size, (i.end - 1) // self.block_size
+        else:
+            first = last = i // self.block_size
+
+        for block in xrange(first, last + 1):
+            if not self._is_set(block):
+                return False
+        return True
+
+    def number(self):
+        return sum(BITS_SET[b] for b in self.bitmap) * self.block_size
+
+    def get_uncovered_portions(self, range):
+        """Determine which blocks overlapping range are not covered.
+
+        Consecutive uncovered blocks are returned as a single Range,
+        always starting and ending on block boundaries.
+        """
+        portions = []
+
+        first = range.start // self.block_size
+        last = (range.end - 1) // self.block_size
+
+        missing_from = None
+        for block in xrange(first, last + 1):
+            if self._is_set(block):
+                if missing_from is not None:
+                    portions.append(Range(missing_from * self.block_size, block * self.block_size))
+                    missing_from = None
+            elif missing_from is None:
+                missing_from = block
+
+        if missing_from is not None:
+            portions.append(Range(missing_from * self.block_size, (last + 1) * self.block_size))
 
         return portions
+
+
+def deserialize(data):
+    """Decode either a Ranges or a BlockBitmap from its on-disk format.
+
+    Raises ValueError if data is in neither format.
+    """
+    if data[:4] == BITMAP_MAGIC:
+        return BlockBitmap.deserialize(data)
+    return Ranges.deserialize(data)
@@ -0,0 +1,155 @@
+"""
+Tracing of the time spent in pcachefs operations, in the Chrome
+trace-event format (see chrome://tracing or https://ui.perfetto.dev).
+"""
+import fcntl
+import functools
+import json
+import os
+import signal
+import thread
+import threading
+import time
+from collections import deque
+
+from pcachefsutil import get_logger
+
+log = get_logger('tracing')
+
+
+class Span(object):
+    """Records the time spent in a with block into the Tracer."""
+    __slots__ = ('spans', 'name', 'args', 'start')
+
+    def __init__(self, spans, name, args):
+        self.spans = spans
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.time()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        # deque.append() is atomic, no lock needed
+        self.spans.append((self.name, self.start, end - self.start, thread.get_ident(), self.args))
+        return False
+
+
+class NoSpan(object):
+    """Returned by Tracer.span() while tracing is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NO_SPAN = NoSpan()
+
+
+class Tracer(object):
+    """Records the last max_spans spans in a ring buffer.
+
+    Usage:
+      with tracer.span('Cacher.read', path=path):
+          ...
+
+    Nothing is recorded unless enabled is set, in which case span()
+    only returns a shared object doing nothing.
+    """
+    def __init__(self, max_spans=100000, enabled=False):
+        self.spans = deque(maxlen=max_spans)
+        self.enabled = enabled
+
+    def span(self, name, **args):
+        """Return a context manager recording the time spent in it as name, with the given args."""
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self.spans, name, args)
+
+    def clear(self):
+        self.spans.clear()
+
+    def dump(self):
+        """Return the spans recorded as Chrome trace-event JSON."""
+        pid = os.getpid()
+        events = []
+        for name, start, duration, tid, args in list(self.spans):
+            events.append({'name': name, 'cat': 'pcachefs', 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': int(start * 1000000), 'dur': int(duration * 1000000), 'args': args})
+
+        for t in threading.enumerate():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': t.ident,
+                           'args': {'name': t.name}})
+
+        return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, default=str) + '\n'
+
+    def dump_to(self, filename):
+        """Write dump() to filename, replacing it atomically."""
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.dump())
+        os.rename(temporary, filename)
+
+
+def traced(name):
+    """Decorate a method whose first argument is a path to record its spans in self.tracer."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, path, *args, **kw):
+            if not self.tracer.enabled:
+                return method(self, path, *args, **kw)
+            with Span(self.tracer.spans, name, {'path': path}):
+                return method(self, path, *args, **kw)
+        return wrapper
+    return decorator
+
+
+class SignalDumper(object):
+    """Writes the trace of a Tracer to filename whenever signum is received.
+
+    Python only runs signal handlers in the main thread, which is busy
+    running the FUSE loop, so the handler is left empty and the signal
+    wakes up a thread through signal.set_wakeup_fd() instead. The
+    constructor must therefore be called from the main thread, while
+    start() can be called after forking.
+    """
+    def __init__(self, tracer, filename, signum=signal.SIGUSR1):
+        self.tracer = tracer
+        self.filename = filename
+        self.thread = None
+
+        self.read_fd, self.write_fd = os.pipe()
+        flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.write_fd)
+        signal.signal(signum, lambda signum, frame: None)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._dump_loop, name='pcachefs-trace')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            dump_thread, self.thread = self.thread, None
+            os.write(self.write_fd, 'q')
+            dump_thread.join()
+
+    def _dump_loop(self):
+        while True:
+            received = os.read(self.read_fd, 64)
+            if 'q' in received:
+                return
+
+            try:
+                self.tracer.dump_to(self.filename)
+                log.info('Trace written to %s', self.filename)
+            except EnvironmentError as e:
+                log.warning('SignalDumper._dump_loop failed writing %s: %s', self.filename, e)
@@ -1,12 +1,21 @@
+import copy
 import os
 import stat
+import threading
 import time
 
 import fuse
 
-from pcachefsutil import debug, is_read_only_flags
+from metrics import (format_json, format_prometheus)
+from prefetch import PrefetchStatus
+from pcachefsutil import get_logger, is_read_only_flags
 from pcachefsutil import (E_NO_SUCH_FILE, E_PERM_DENIED, E_NOT_IMPL)
 
+log = get_logger('vfs')
+
+# Files at the root of the virtual directory reporting metrics and traces
+REPORT_FILES = ['stats', 'stats.prom', 'trace']
+
 
 class SimpleVirtualFile(object):
     """
@@ -165,14 +174,85 @@ class VirtualFS(object):
 
     Virtual files are represented by instances of VirtualFile stored in
     a dict. Virtual files can be made read-only or writeable.
+
+    If a Prefetcher is given, each directory also contains a 'prefetch'
+    file, writing 1 to which queues the directory tree to be fetched in
+    the background, and a 'prefetch_status' file reporting its progress.
+
+    The root of the virtual directory also contains the 'stats' and
+    'stats.prom' files, reporting the metrics of the Cacher as JSON and
+    in the Prometheus text format, and the 'trace' file, returning the
+    spans recorded by its Tracer as Chrome trace-event JSON. Writing 1
+    or 0 to 'trace' enables or disables tracing.
+
+    A real entry of the target with the same name as one of these files
+    hides it, so that its own virtual files stay reachable.
     """
-    def __init__(self, root, cacher):
+    def __init__(self, root, cacher, prefetcher=None):
         """Initialise a new VirtualFileFS.
 
         Root folder under which all virtual objects will reside.
         """
         self.root = root
         self.cacher = cacher
+        self.prefetcher = prefetcher
+
+        # Content of each open report file as of its first read, so
+        # that the following reads return the rest of the same content,
+        # and its number of open handles, once closed it is freed
+        self.reports = {}
+        self.report_opens = {}
+        self.reports_lock = threading.Lock()
+
+    def _exists(self, virtual_path):
+        """Return whether virtual_path exists in the target, from the cached listing of its directory."""
+        name = os.path.basename(virtual_path)
+        try:
+            entries = self.cacher.readdir(os.sep + os.path.dirname(virtual_path), 0)
+            return any(entry.name == name for entry in entries)
+        except (IOError, OSError):
+            return False
+
+    def _is_report(self, virtual_path):
+        return virtual_path in REPORT_FILES and not self._exists(virtual_path)
+
+    def _is_directory_control(self, virtual_path):
+        return (self.prefetcher is not None
+                and os.path.basename(virtual_path) in ['prefetch', 'prefetch_status']
+                and not self._exists(virtual_path))
+
+    def _get_prefetch_status(self, path):
+        status = self.prefetcher.status(path) or PrefetchStatus()
+        return status.format()
+
+    def _get_report(self, virtual_path):
+        with self.reports_lock:
+            content = self.reports.get(virtual_path)
+            if content is not None:
+                return content
+
+            if virtual_path == 'trace':
+                content = self.cacher.tracer.dump()
+            elif virtual_path == 'stats':
+                content = format_json(*self.cacher.get_metrics())
+            else:
+                content = format_prometheus(*self.cacher.get_metrics())
+
+            if self.report_opens.get(virtual_path):
+                self.reports[virtual_path] = content
+            return content
+
+    def _open_report(self, virtual_path):
+        with self.reports_lock:
+            self.report_opens[virtual_path] = self.report_opens.get(virtual_path, 0) + 1
+
+    def _release_report(self, virtual_path):
+        with self.reports_lock:
+            count = self.report_opens.pop(virtual_path, 0) - 1
+            if count > 0:
+                self.report_opens[virtual_path] = count
+            else:
+                self.reports.pop(virtual_path, None)
 
     def get_relative_path(self, path):
         """Returns path relative to the given root virtual folder."""
@@ -190,110 +270,178 @@ class VirtualFS(object):
 
     def getattr(self, path):
         """Retrieve attributes of a path in the VirtualFS."""
-        debug('VirtualFS.getattr', path)
+        log.debug('VirtualFS.getattr %s', path)
         virtual_path = self.get_relative_path(path)
         if virtual_path is None:
             return E_NO_SUCH_FILE
 
         parent_path = os.sep + os.path.dirname(virtual_path)
+        if self._is_report(virtual_path):
+            a = copy.copy(self.cacher.getattr(parent_path))
+            a.st_mode = stat.S_IFREG | (0o644 if virtual_path == 'trace' else 0o444)
+            # Only built to be measured when open() cannot ask for
+            # direct_io, otherwise reads are not cut at st_size
+            content = self.reports.get(virtual_path)
+            if content is None and not hasattr(fuse, 'FuseFileInfo'):
+                content = self._get_report(virtual_path)
+            a.st_size = 0 if content is None else len(content)
+            a.st_nlink = 1
+            return a
+
         parent_is_file = stat.S_ISREG(self.cacher.getattr(parent_path).st_mode)
         if parent_is_file:
             if os.path.basename(virtual_path) not in ['cached']:
                 return E_NO_SUCH_FILE
             return self.cacher.getattr(parent_path)
+        elif self._is_directory_control(virtual_path):
+            a = copy.copy(self.cacher.getattr(parent_path))
+            if os.path.basename(virtual_path) == 'prefetch':
+                a.st_mode = stat.S_IFREG | 0o200
+                a.st_size = 0
+            else:
+                a.st_mode = stat.S_IFREG | 0o444
+                a.st_size = len(self._get_prefetch_status(parent_path))
+            a.st_nlink = 1
+            return a
         else:
-            a = self.cacher.getattr(os.sep + virtual_path)
+            # the Cacher's stat objects are shared, modify a copy
+            a = copy.copy(self.cacher.getattr(os.sep + virtual_path))
             a.st_mode = stat.S_IFDIR | 0o777
             return a
 
-    def readdir(self, path, offset):
-        debug('VirtualFS.readdir', path, offset)
+    def readdir(self, path):
+        """Yield the virtual entries of path, followed by None if path is virtual."""
+        log.debug('VirtualFS.readdir %s', path)
         virtual_path = self.get_relative_path(path)
         if virtual_path is not None:
             is_file = stat.S_ISREG(self.cacher.getattr(os.sep + virtual_path).st_mode)
             if is_file:
                 yield fuse.Direntry('cached')
             else:
-                for f in self.cacher.readdir(os.sep + virtual_path, offset):
+                controls = []
+                if virtual_path == '':
+                    controls.extend(REPORT_FILES)
+                if self.prefetcher is not None:
+                    controls.extend(['prefetch', 'prefetch_status'])
+
+                # entries of the target hide the controls of the same name
+                hidden = set()
+                for f in self.cacher.readdir(os.sep + virtual_path, 0):
+                    if f.name in controls:
+                        hidden.add(f.name)
                     yield fuse.Direntry(f.name)
+                for name in controls:
+                    if name not in hidden:
+                        yield fuse.Direntry(name)
             yield None
 
         if path == '/':
             yield fuse.Direntry(self.root)
 
     def open(self, path, flags):
-        debug('VirtualFS.open', path, flags)
+        log.debug('VirtualFS.open %s %s', path, flags)
         virtual_path = self.get_relative_path(path)
         if virtual_path is None:
             return E_NO_SUCH_FILE
 
-        if os.path.basename(virtual_path) in ['cached']:
+        basename = os.path.basename(virtual_path)
+        if basename == 'cached' or (basename == 'prefetch' and self._is_directory_control(virtual_path)):
             return 0
 
-        if not is_read_only_flags(flags):
+        is_report = self._is_report(virtual_path)
+        if not is_read_only_flags(flags) and not (is_report and virtual_path == 'trace'):
             return E_PERM_DENIED
 
+        if is_report:
+            self._open_report(virtual_path)
+
+        if is_report and hasattr(fuse, 'FuseFileInfo'):
+            # The size of report files is not known by getattr(), so
+            # the kernel must not cut reads at st_size
+            return fuse.FuseFileInfo(direct_io=True)
+
         return 0
 
     def read(self, path, size, offset):
-        debug('VirtualFS.read', path, size, offset)
+        log.debug('VirtualFS.read %s %s %s', path, size, offset)
         virtual_path = self.get_relative_path(path)
         if virtual_path is None:
             return E_NO_SUCH_FILE
 
+        if self._is_report(virtual_path):
+            return self._get_report(virtual_path)[offset:offset+size]
+
         parent_path = os.sep + os.path.dirname(virtual_path)
         parent_is_file = stat.S_ISREG(self.cacher.getattr(parent_path).st_mode)
+        basename = os.path.basename(virtual_path)
         if not parent_is_file:
+            if basename == 'prefetch_status' and self._is_directory_control(virtual_path):
+                return self._get_prefetch_status(parent_path)[offset:offset+size]
             return E_NO_SUCH_FILE
 
-        basename = os.path.basename(virtual_path)
         if basename != 'cached':
             return E_NO_SUCH_FILE
 
         attr = self.cacher.getattr(parent_path)
-        return str(self.cacher.get_cached_blocks(parent_path).number() / float(attr.st_size * attr.st_blksize))
+        if attr.st_size == 0:
+            return str(1.0)
+
+        # the last block of a BlockBitmap may extend past the end of the file
+        return str(min(1.0, self.cacher.get_cached_blocks(parent_path).number() / float(attr.st_size)))
 
     def mknod(self, path, mode, dev):  # pylint: disable=no-self-use
-        debug('VirtualFS.mknod', path, mode, dev)
+        log.debug('VirtualFS.mknod %s %s %s', path, mode, dev)
         # Don't allow creation of new files
         return E_PERM_DENIED
 
     def unlink(self, path):  # pylint: disable=no-self-use
-        debug('VirtualFS.unlink', path)
+        log.debug('VirtualFS.unlink %s', path)
         # Don't allow removal of files
         return E_PERM_DENIED
 
     def write(self, path, buf, offset):
-        debug('VirtualFS.write', path, buf, offset)
+        log.debug('VirtualFS.write %s %d bytes at %d', path, len(buf), offset)
         virtual_path = self.get_relative_path(path)
         if virtual_path is None:
             return E_NO_SUCH_FILE
 
+        if virtual_path == 'trace' and self._is_report(virtual_path):
+            if buf.strip() not in ('0', '1'):
+                return E_NOT_IMPL
+            self.cacher.tracer.enabled = buf.strip() == '1'
+            return len(buf)
+
         basename = os.path.basename(virtual_path)
         if basename == 'cached':
             real_path = os.sep + os.path.dirname(virtual_path)
             if buf == '1':
-                attr = self.cacher.underlying_fs.getattr(real_path)
-                size = attr.st_size * attr.st_blksize
-                self.cacher.read(real_path, size, 0, force_reload=True)
+                self.cacher.prefetch(real_path, force_reload=True)
             elif buf == '0':
                 self.cacher.remove_cached_data(real_path)
             else:
                 return E_NOT_IMPL
             return len(buf)
+        elif basename == 'prefetch' and self._is_directory_control(virtual_path):
+            if buf.strip() != '1':
+                return E_NOT_IMPL
+            self.prefetcher.prefetch(os.sep + os.path.dirname(virtual_path))
+            return len(buf)
         else:
             return E_NO_SUCH_FILE
 
     def truncate(self, path, size):  # pylint: disable=no-self-use
-        debug('VirtualFS.truncate', path, size)
+        log.debug('VirtualFS.truncate %s %s', path, size)
         return 0
 
     def flush(self, path, fh=None):  # pylint: disable=no-self-use, unused-argument
-        debug('VirtualFS.flush', path)
+        log.debug('VirtualFS.flush %s', path)
         return 0
 
-    def release(self, path, fh=None):  # pylint: disable=no-self-use, unused-argument
-        debug('VirtualFS.release', path)
+    def release(self, path, fh=None):  # pylint: disable=unused-argument
+        log.debug('VirtualFS.release %s', path)
+        virtual_path = self.get_relative_path(path)
+        if virtual_path in REPORT_FILES:
+            self._release_report(virtual_path)
         return 0
 
 
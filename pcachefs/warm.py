@@ -0,0 +1,242 @@
+"""
+Warm the cache of pcachefs without mounting it.
+
+pcachefs-warm walks directory trees of the target directory and fetches
+every file into the cache directory, the way reading them through a
+pcachefs mount would. Only the data not cached yet is fetched, so an
+interrupted run resumes where it stopped when started again.
+
+  $ pcachefs-warm -c /cache -t /remote -j 8 --max-bandwidth 20M /movies /music
+"""
+import optparse
+import os
+import Queue
+import stat
+import sys
+import threading
+import time
+
+from pcachefs import (Cacher, UnderlyingFs)
+from pcachefsutil import (configure_logging, format_size, get_logger, parse_size, RateLimiter)
+
+log = get_logger('warm')
+
+
+class WarmingStopped(Exception):
+    """Raised in the worker threads once stop() has been called."""
+    pass
+
+
+class Warmer(object):
+    """Fetches whole directory trees into the cache of a Cacher.
+
+    Files are fetched by threads threads, chunk_size bytes at a time,
+    at most max_bandwidth bytes per second for all of them together if
+    given. Progress is written to out every report_interval seconds.
+    """
+    def __init__(self, cacher, threads=4, max_bandwidth=None, chunk_size=4 * 1024 * 1024,
+                 out=sys.stdout, report_interval=10):
+        self.cacher = cacher
+        self.threads = threads
+        self.limiter = RateLimiter(max_bandwidth) if max_bandwidth else None
+        self.chunk_size = chunk_size
+        self.out = out
+        self.report_interval = report_interval
+
+        self.lock = threading.Lock()
+        self.files = 0
+        self.fetched = 0
+        self.errors = 0
+        self.start_time = None
+        self.last_report = None
+
+        self.stopped = threading.Event()
+
+    def warm(self, paths):
+        """Fetch every file under the given paths, which are relative to the target directory.
+
+        Returns False if interrupted by stop() or a KeyboardInterrupt.
+        """
+        self.start_time = self.last_report = time.time()
+
+        queue = Queue.Queue(self.threads * 4)
+        workers = []
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self._work, args=(queue,), name='pcachefs-warm')
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        try:
+            for path in paths:
+                for file_path in self.walk(path):
+                    self._put(queue, file_path)
+        except KeyboardInterrupt:
+            self._interrupt()
+
+        for _ in workers:
+            self._put(queue, None)
+
+        # Join with a timeout so that the main thread can be interrupted
+        # and report progress
+        for worker in workers:
+            while worker.is_alive():
+                try:
+                    worker.join(1)
+                except KeyboardInterrupt:
+                    self._interrupt()
+                self._report_if_due()
+
+        self.report()
+        return not self.stopped.is_set()
+
+    def stop(self):
+        """Make the worker threads stop after the chunk they are fetching."""
+        self.stopped.set()
+
+    def walk(self, path):
+        """Yield the regular files under path, listing directories through the Cacher."""
+        visited = set()
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            try:
+                st = self.cacher.getattr(path)
+                if stat.S_ISREG(st.st_mode):
+                    yield path
+                    continue
+
+                if not stat.S_ISDIR(st.st_mode) or (st.st_dev, st.st_ino) in visited:
+                    continue
+                visited.add((st.st_dev, st.st_ino))
+
+                names = [entry.name for entry in self.cacher.readdir(path, 0)]
+            except (IOError, OSError) as e:
+                self._error(path, e)
+                continue
+
+            for name in sorted(names, reverse=True):
+                if name not in ('.', '..'):
+                    pending.append(os.path.join(path, name))
+
+    def report(self):
+        """Write the number of files and bytes fetched so far, and the throughput."""
+        with self.lock:
+            elapsed = max(time.time() - self.start_time, 0.001)
+            self.out.write('%d files, %s fetched in %.0fs (%s/s), %d errors\n' % (
+                self.files, format_size(self.fetched), elapsed,
+                format_size(int(self.fetched / elapsed)), self.errors))
+            self.out.flush()
+            self.last_report = time.time()
+
+    def _interrupt(self):
+        sys.stderr.write('Interrupted, finishing the chunks being fetched\n')
+        self.stop()
+
+    def _put(self, queue, item):
+        while True:
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                self._report_if_due()
+
+    def _report_if_due(self):
+        if self.report_interval and time.time() - self.last_report >= self.report_interval:
+            self.report()
+
+    def _work(self, queue):
+        while True:
+            path = queue.get()
+            if path is None:
+                return
+
+            if self.stopped.is_set():
+                continue
+
+            try:
+                fetched = self.cacher.prefetch(path, self.chunk_size, throttle=self._throttle)
+            except WarmingStopped:
+                continue
+            except Exception as e:  # pylint: disable=broad-except
+                self._error(path, e)
+                continue
+
+            with self.lock:
+                self.files += 1
+
+            log.debug('Warmer._work done %s %s', path, fetched)
+
+    def _throttle(self, size):
+        if self.stopped.is_set():
+            raise WarmingStopped()
+
+        if self.limiter is not None:
+            self.limiter.consume(size)
+
+        # Counted before the chunk is fetched, so that the throughput
+        # reported does not lag
+        with self.lock:
+            self.fetched += size
+
+    def _error(self, path, e):
+        with self.lock:
+            self.errors += 1
+        sys.stderr.write('%s: %s\n' % (path, e))
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog -c CACHE_DIR -t TARGET_DIR [options] [PATH ...]',
+                                   description="Fetch the files under the given paths of the target directory, "
+                                   "/ by default, into the cache directory of pcachefs.")
+    parser.add_option('-c', '--cache-dir', dest='cache_dir', help="The directory where cached data is stored, as given to pcachefs.")
+    parser.add_option('-t', '--target-dir', dest='target_dir', help="The directory which is cached, as given to pcachefs.")
+    parser.add_option('--metadata', dest='metadata', type='choice', choices=['files', 'sqlite'], default='files', help="Where cached metadata is stored, as given to pcachefs.")
+    parser.add_option('--block-size', dest='block_size', help="The block size of the cache, as given to pcachefs.")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=4, help="Number of files fetched at the same time. Defaults to 4.")
+    parser.add_option('--max-bandwidth', dest='max_bandwidth', help="Maximum number of bytes fetched per second by all jobs together (e.g. 20M). By default there is no limit.")
+    parser.add_option('--chunk-size', dest='chunk_size', default='4M', help="Number of bytes fetched at a time from each file. Defaults to 4M.")
+    parser.add_option('--report-interval', dest='report_interval', type='float', default=10, help="Number of seconds between two progress reports. Defaults to 10.")
+    parser.add_option('--log-level', dest='log_level', default='warning', help="Level of the messages written to the standard error, as given to pcachefs (e.g. debug or warning,warm=debug). Defaults to warning.")
+    parser.add_option('--log-sample', dest='log_sample', default='', help="Only log one debug message out of so many for the given subsystems, as given to pcachefs.")
+    options, paths = parser.parse_args(args)
+
+    if options.cache_dir is None:
+        parser.error('Need to specify --cache-dir')
+    if options.target_dir is None:
+        parser.error('Need to specify --target-dir')
+
+    sizes = {}
+    for name in ('block_size', 'max_bandwidth', 'chunk_size'):
+        value = getattr(options, name)
+        try:
+            sizes[name] = None if value is None else parse_size(value)
+            if sizes[name] is not None and sizes[name] < 1:
+                raise ValueError('size must be positive')
+        except ValueError:
+            parser.error('Invalid --%s %s' % (name.replace('_', '-'), value))
+
+    paths = [os.sep + path.strip(os.sep) for path in paths] or [os.sep]
+
+    try:
+        configure_logging(options.log_level, options.log_sample)
+    except ValueError as e:
+        parser.error('Invalid --log-level or --log-sample: %s' % e)
+
+    cacher = Cacher(options.cache_dir, UnderlyingFs(options.target_dir),
+                    block_size=sizes['block_size'], metadata=options.metadata)
+    warmer = Warmer(cacher, threads=options.jobs, max_bandwidth=sizes['max_bandwidth'],
+                    chunk_size=sizes['chunk_size'], report_interval=options.report_interval)
+
+    cacher.start()
+    try:
+        completed = warmer.warm(paths)
+    finally:
+        # Records what was fetched, so that the next run resumes from there
+        cacher.stop()
+
+    return 0 if completed and not warmer.errors else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
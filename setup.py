@@ -12,7 +12,10 @@ setup(
     license='Apache 2.0',
 
     entry_points={
-        'console_scripts': 'pcachefs=pcachefs.pcachefs:main',
+        'console_scripts': [
+            'pcachefs=pcachefs.pcachefs:main',
+            'pcachefs-warm=pcachefs.warm:main',
+        ],
     },
     packages=['pcachefs'],
 
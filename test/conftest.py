@@ -0,0 +1,29 @@
+#For pytest, pylint: disable=redefined-outer-name
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from pcachefs.pcachefs import Cacher, UnderlyingFs
+
+
+@pytest.fixture
+def dirs():
+    """A target directory holding a/f (100000 bytes), a/b/g (3 bytes) and an empty h, and a cache directory."""
+    target_dir = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(target_dir, 'a', 'b'))
+    for name, size in [('a/f', 100000), ('a/b/g', 3), ('h', 0)]:
+        with open(os.path.join(target_dir, name), 'wb') as f:
+            f.write('x' * size)
+    yield target_dir, cache_dir
+    shutil.rmtree(target_dir)
+    shutil.rmtree(cache_dir)
+
+
+@pytest.fixture
+def cacher(dirs):
+    target_dir, cache_dir = dirs
+    return Cacher(cache_dir, UnderlyingFs(target_dir))
@@ -192,7 +192,7 @@ def test_cached_directory_not_updated(pcachefs, sourcedir, mountdir):
 def test_read_cache(pcachefs, sourcedir, mountdir):
     write_to_file(sourcedir, ['a'], '1')
     assert list_dir(mountdir) == ListDir(['a'], ['.pcachefs'])
-    assert list_dir(mountdir, ['.pcachefs']) == ListDir([], ['a'])
+    assert list_dir(mountdir, ['.pcachefs']) == ListDir(['prefetch', 'prefetch_status', 'stats', 'stats.prom', 'trace'], ['a'])
     assert list_dir(mountdir, ['.pcachefs', 'a']) == ListDir(['cached'], [])
     assert read_from_file(mountdir, ['.pcachefs', 'a', 'cached']) == '0'
     read_from_file(mountdir, ['a'])
@@ -223,3 +223,42 @@ def test_remove_cache(pcachefs, sourcedir, mountdir, cachedir):
     assert read_from_file(cachedir, ['a', 'cache.data']) is None
     assert read_from_file(mountdir, ['a']) == '1'
     assert read_from_file(cachedir, ['a', 'cache.data']) == '1'
+
+
+def test_cached_blocks_written_on_close(pcachefs, sourcedir, mountdir, cachedir):
+    write_to_file(sourcedir, ['a'], '1')
+    assert read_from_file(cachedir, ['a', 'cache.data.range']) is None
+    assert read_from_file(mountdir, ['a']) == '1'
+    assert read_from_file(cachedir, ['a', 'cache.data.range']) is not None
+
+
+def test_prefetch_directory(pcachefs, sourcedir, mountdir, cachedir):
+    create_directory(sourcedir, ['d'])
+    write_to_file(sourcedir, ['d', 'a'], '1')
+    write_to_file(mountdir, ['.pcachefs', 'd', 'prefetch'], '1')
+    time.sleep(.5)
+    assert read_from_file(cachedir, ['d', 'a', 'cache.data']) == '1'
+    assert 'completed                      1' in read_from_file(mountdir, ['.pcachefs', 'd', 'prefetch_status'])
+
+
+def test_stats(pcachefs, sourcedir, mountdir):
+    write_to_file(sourcedir, ['a'], '1')
+    read_from_file(mountdir, ['a'])
+    assert '"read_bytes": 1' in read_from_file(mountdir, ['.pcachefs', 'stats'])
+    assert 'pcachefs_read_seconds_count' in read_from_file(mountdir, ['.pcachefs', 'stats.prom'])
+
+
+def test_trace(pcachefs, sourcedir, mountdir):
+    write_to_file(sourcedir, ['a'], '1')
+    write_to_file(mountdir, ['.pcachefs', 'trace'], '1')
+    read_from_file(mountdir, ['a'])
+    write_to_file(mountdir, ['.pcachefs', 'trace'], '0')
+    assert '"Cacher.read"' in read_from_file(mountdir, ['.pcachefs', 'trace'])
+
+
+def test_target_entries_hide_controls(pcachefs, sourcedir, mountdir):
+    write_to_file(sourcedir, ['stats'], '1')
+    create_directory(sourcedir, ['prefetch'])
+    assert list_dir(mountdir, ['.pcachefs']) == ListDir(['prefetch_status', 'stats.prom', 'trace'], ['prefetch', 'stats'])
+    assert list_dir(mountdir, ['.pcachefs', 'stats']) == ListDir(['cached'], [])
+    assert read_from_file(mountdir, ['.pcachefs', 'stats', 'cached']) == '0'
@@ -0,0 +1,523 @@
+#For pytest, pylint: disable=redefined-outer-name
+
+import errno
+import os
+import threading
+import time
+
+import pytest
+
+from pcachefs.pcachefs import Cacher, UnderlyingFs
+
+
+class RecordingFs(UnderlyingFs):
+    """Records the paths looked up and the (offset, size) of the reads and copies from the target."""
+    def __init__(self, real_path):
+        UnderlyingFs.__init__(self, real_path)
+        self.reads = []
+        self.copies = []
+        self.getattrs = []
+
+    def getattr(self, path):
+        self.getattrs.append(path)
+        return UnderlyingFs.getattr(self, path)
+
+    def read(self, path, size, offset):
+        self.reads.append((offset, size))
+        return UnderlyingFs.read(self, path, size, offset)
+
+    def copy(self, path, size, offset, dest_pool, dest_filename):
+        self.copies.append((offset, size))
+        return UnderlyingFs.copy(self, path, size, offset, dest_pool, dest_filename)
+
+
+class FailingFs(UnderlyingFs):
+    """Fails getattr() with the errno error if set, and blocks reads while blocked is set.
+
+    The (offset, size) of reads are recorded.
+    """
+    def __init__(self, real_path):
+        UnderlyingFs.__init__(self, real_path)
+        self.error = None
+        self.blocked = threading.Event()
+        self.reading = threading.Event()
+        self.reads = []
+
+    def getattr(self, path):
+        if self.error is not None:
+            raise OSError(self.error, os.strerror(self.error), path)
+        return UnderlyingFs.getattr(self, path)
+
+    def read(self, path, size, offset):
+        self.reads.append((offset, size))
+        self.reading.set()
+        while self.blocked.is_set():
+            self.blocked.wait(0.01)
+        return UnderlyingFs.read(self, path, size, offset)
+
+
+class SlowGetattrFs(RecordingFs):
+    """Blocks getattr() of slow_path after the first one until released is set, setting checking meanwhile."""
+    def __init__(self, real_path, slow_path):
+        RecordingFs.__init__(self, real_path)
+        self.slow_path = slow_path
+        self.checking = threading.Event()
+        self.released = threading.Event()
+
+    def getattr(self, path):
+        slow = path == self.slow_path and path in self.getattrs
+        self.getattrs.append(path)
+        if slow:
+            self.checking.set()
+            self.released.wait(5)
+        return UnderlyingFs.getattr(self, path)
+
+
+def disk_usage(cache_dir, *names):
+    return sum(os.stat(os.path.join(cache_dir, name, 'cache.data')).st_blocks * 512 for name in names)
+
+
+def test_cache_index_across_restarts(dirs):
+    target_dir, cache_dir = dirs
+    cacher = Cacher(cache_dir, UnderlyingFs(target_dir))
+    cacher.read('/a/f', 65536, 0)
+    cacher.read('/a/b/g', 3, 0)
+    cacher.flush_cached_blocks()
+
+    # used before the cache directory has been scanned: /a/f is
+    # fetched further, /a/b/g read from the cache
+    cacher = Cacher(cache_dir, UnderlyingFs(target_dir))
+    cacher.read('/a/f', 4096, 90000)
+    cacher.read('/a/b/g', 3, 0)
+    assert cacher.cache_index.total == disk_usage(cache_dir, 'a/f')
+
+    cacher.cache_index.load(cacher.metadata.list_data())
+    assert cacher.cache_index.total == disk_usage(cache_dir, 'a/f', 'a/b/g')
+    assert cacher.cache_index.least_recently_used() == ['/a/f', '/a/b/g']
+
+    # data fetched again is not counted twice
+    cacher.read('/a/f', 4096, 0, force_reload=True)
+    assert cacher.cache_index.total == disk_usage(cache_dir, 'a/f', 'a/b/g')
+
+
+def test_evict_cache(dirs):
+    target_dir, cache_dir = dirs
+    cacher = Cacher(cache_dir, UnderlyingFs(target_dir))
+    cacher.open('/a/f', os.O_RDONLY)
+    cacher.read('/a/f', 100000, 0)
+    cacher.read('/a/b/g', 3, 0)
+    cacher.cache_index.load(cacher.metadata.list_data())
+
+    # /a/f is open
+    cacher.evict_cache(0)
+    assert os.path.exists(os.path.join(cache_dir, 'a', 'f', 'cache.data'))
+    assert not os.path.exists(os.path.join(cache_dir, 'a', 'b', 'g', 'cache.data'))
+    assert cacher.get_cached_blocks('/a/b/g').number() == 0
+
+    cacher.release('/a/f', os.O_RDONLY)
+    cacher.read('/a/b/g', 3, 0)
+
+    # least recently used first, only until the cache fits
+    cacher.evict_cache(disk_usage(cache_dir, 'a/b/g'))
+    assert not os.path.exists(os.path.join(cache_dir, 'a', 'f', 'cache.data'))
+    assert os.path.exists(os.path.join(cache_dir, 'a', 'b', 'g', 'cache.data'))
+    assert cacher.cache_index.total == disk_usage(cache_dir, 'a/b/g')
+    assert cacher.read('/a/b/g', 3, 0) == 'xxx'
+
+
+def test_concurrent_reads_fetch_once(dirs):
+    target_dir, cache_dir = dirs
+    underlying_fs = FailingFs(target_dir)
+    cacher = Cacher(cache_dir, underlying_fs)
+    results = []
+
+    def read(offset):
+        results.append(cacher.read('/a/f', 8192, offset))
+
+    underlying_fs.blocked.set()
+    first = threading.Thread(target=read, args=(0,))
+    first.start()
+    assert underlying_fs.reading.wait(5)
+
+    # readers of the region being fetched wait for it
+    others = [threading.Thread(target=read, args=(offset,)) for offset in (0, 4096)]
+    for thread in others:
+        thread.start()
+    time.sleep(0.1)
+    underlying_fs.blocked.clear()
+    for thread in [first] + others:
+        thread.join(5)
+
+    assert results == ['x' * 8192] * 3
+    assert underlying_fs.reads == [(0, 8192), (8192, 4096)]
+
+
+def test_misses_served_from_fetched_data(dirs):
+    target_dir, cache_dir = dirs
+    underlying_fs = RecordingFs(target_dir)
+    cacher = Cacher(cache_dir, underlying_fs)
+    store_fetched_data = cacher._store_fetched_data  # pylint: disable=protected-access
+
+    def store_and_corrupt(path, fetched, done):
+        store_fetched_data(path, fetched, done)
+        with open(os.path.join(cache_dir, 'a', 'f', 'cache.data'), 'r+b') as f:
+            f.write('z' * 100000)
+
+    cacher._store_fetched_data = store_and_corrupt  # pylint: disable=protected-access
+
+    # cache.data is not read back
+    assert cacher.read('/a/f', 8192, 0) == 'x' * 8192
+    assert underlying_fs.reads == [(0, 8192)]
+
+    # only the part which was cached before is read from it
+    assert cacher.read('/a/f', 8192, 4096) == 'z' * 4096 + 'x' * 4096
+    assert underlying_fs.reads == [(0, 8192), (8192, 4096)]
+
+
+def test_hits_near_end_of_file(dirs, monkeypatch):
+    target_dir, cache_dir = dirs
+    cacher = Cacher(cache_dir, UnderlyingFs(target_dir), max_mapped_files=2)
+    assert cacher.read('/a/f', 4096, 98304) == 'x' * 1696
+
+    maps = []
+    map_file = cacher.mapped_files._map
+    monkeypatch.setattr(cacher.mapped_files, '_map', lambda *args: maps.append(args) or map_file(*args))
+    checked = []
+    exists = os.path.exists
+    monkeypatch.setattr(os.path, 'exists', lambda path: checked.append(path) or exists(path))
+
+    data = [cacher.read('/a/f', 4096, 98304) for _ in range(3)]
+    monkeypatch.undo()
+    assert data == ['x' * 1696] * 3
+    assert maps == []
+    assert checked == []
+
+
+def test_coverage_written_without_blocking_hits(cacher):
+    cacher.read('/a/f', 4096, 0)
+    cacher.read('/a/b/g', 3, 0)
+
+    writing = threading.Event()
+    written = threading.Event()
+    put_coverage = cacher.metadata.put_coverage
+
+    def slow_put_coverage(path, data):
+        writing.set()
+        written.wait(5)
+        put_coverage(path, data)
+
+    cacher.metadata.put_coverage = slow_put_coverage
+    flush = threading.Thread(target=cacher.flush_cached_blocks, args=('/a/f',))
+    flush.start()
+    assert writing.wait(5)
+
+    # other files are still served while /a/f is being written
+    assert cacher.read('/a/b/g', 3, 0) == 'xxx'
+    assert flush.is_alive()
+
+    written.set()
+    flush.join()
+
+
+def test_readahead_in_background(dirs):
+    target_dir, cache_dir = dirs
+    for block_size in (None, 1024):
+        underlying_fs = RecordingFs(target_dir)
+        cacher = Cacher(cache_dir, underlying_fs, block_size=block_size, max_readahead=65536)
+        cacher.remove_cached_blocks('/a/f')
+
+        cacher.read('/a/f', 4096, 0)
+        assert cacher.read('/a/f', 4000, 4096) == 'x' * 4000
+
+        # only the data read is fetched by the reader, read-ahead is
+        # copied into the cache
+        assert underlying_fs.reads == [(0, 4096), (4096, 4000 if block_size is None else 4096)]
+        assert underlying_fs.copies == [(8096, 4000) if block_size is None else (8192, 4096)]
+        assert cacher.get_cached_blocks('/a/f').number() == (12096 if block_size is None else 12288)
+
+
+def test_attr_timeout_invalidates_changed_files(dirs):
+    target_dir, cache_dir = dirs
+    cacher = Cacher(cache_dir, UnderlyingFs(target_dir), attr_timeout=0)
+    list(cacher.readdir('/a', 0))
+    cacher.read('/a/f', 100000, 0)
+    cacher.read('/a/b/g', 3, 0)
+
+    # modification time changed
+    os.utime(os.path.join(target_dir, 'a', 'f'), (1, 1))
+    assert cacher.getattr('/a/f').st_mtime == 1
+    assert cacher.get_cached_blocks('/a/f').number() == 0
+    assert cacher.get_cached_blocks('/a/b/g').number() == 3
+    assert cacher.metadata.get_listing('/a') is not None
+
+    # size changed
+    with open(os.path.join(target_dir, 'a', 'b', 'g'), 'wb') as f:
+        f.write('yyyy')
+    assert cacher.getattr('/a/b/g').st_size == 4
+    assert cacher.get_cached_blocks('/a/b/g').number() == 0
+    assert cacher.read('/a/b/g', 4, 0) == 'yyyy'
+
+
+def test_attr_timeout_keeps_cache_on_errors(dirs):
+    target_dir, cache_dir = dirs
+    underlying_fs = FailingFs(target_dir)
+    cacher = Cacher(cache_dir, underlying_fs, attr_timeout=0)
+    cacher.read('/a/b/g', 3, 0)
+
+    underlying_fs.error = errno.EIO
+    assert cacher.getattr('/a/b/g').st_size == 3
+    assert cacher.read('/a/b/g', 3, 0) == 'xxx'
+    assert cacher.get_cached_blocks('/a/b/g').number() == 3
+
+    underlying_fs.error = errno.ENOENT
+    with pytest.raises(OSError):
+        cacher.getattr('/a/b/g')
+    assert not os.path.exists(os.path.join(cache_dir, 'a', 'b', 'g', 'cache.data'))
+
+
+def test_attr_timeout_during_fetch(dirs):
+    target_dir, cache_dir = dirs
+    underlying_fs = FailingFs(target_dir)
+    cacher = Cacher(cache_dir, underlying_fs, attr_timeout=0, max_readahead=65536, block_size=4096)
+    cacher.read('/a/f', 4096, 0)
+    cacher.read('/a/b/g', 3, 0)
+
+    # a slow fetch is in progress when the file changes, and a
+    # sequential reader misses
+    underlying_fs.blocked.set()
+    underlying_fs.reading.clear()
+    slow = threading.Thread(target=cacher.read, args=('/a/f', 4096, 65536))
+    slow.start()
+    underlying_fs.reading.wait()
+    os.utime(os.path.join(target_dir, 'a', 'f'), (1, 1))
+
+    sequential = threading.Thread(target=cacher.read, args=('/a/f', 4096, 69632))
+    sequential.start()
+    other = threading.Thread(target=cacher.read, args=('/a/b/g', 3, 0))
+    other.start()
+    other.join(5)
+    assert not other.is_alive()
+
+    underlying_fs.blocked.clear()
+    slow.join(5)
+    sequential.join(5)
+    assert not slow.is_alive() and not sequential.is_alive()
+
+
+@pytest.mark.parametrize('started', [False, True])
+def test_sequential_read_across_change(dirs, started):
+    target_dir, cache_dir = dirs
+    underlying_fs = RecordingFs(target_dir)
+    cacher = Cacher(cache_dir, underlying_fs, attr_timeout=0, max_readahead=65536, block_size=4096)
+    if started:
+        cacher.start()
+    try:
+        assert cacher.read('/a/f', 4096, 0) == 'x' * 4096
+        assert cacher.read('/a/f', 4096, 4096) == 'x' * 4096
+
+        with open(os.path.join(target_dir, 'a', 'f'), 'wb') as f:
+            f.write('y' * 100001)
+        assert cacher.read('/a/f', 4096, 8192) == 'y' * 4096
+    finally:
+        if started:
+            cacher.stop()
+
+    # what was fetched for the new version is cached
+    del underlying_fs.reads[:], underlying_fs.copies[:]
+    assert cacher.read('/a/f', 4096, 8192) == 'y' * 4096
+    assert underlying_fs.reads == underlying_fs.copies == []
+
+
+def test_stale_attributes_refreshed_once(dirs):
+    target_dir, cache_dir = dirs
+    underlying_fs = SlowGetattrFs(target_dir, '/a/f')
+    cacher = Cacher(cache_dir, underlying_fs, attr_timeout=0.05, max_stale=60, refresh_threads=1, max_refresh=1)
+    for path in ['/a/f', '/a/b/g', '/h']:
+        cacher.getattr(path)
+    time.sleep(0.1)
+    os.utime(os.path.join(target_dir, 'a', 'f'), (1, 1))
+
+    cacher.start()
+    try:
+        # served right away while a single check is running
+        for _ in range(3):
+            assert cacher.getattr('/a/f').st_mtime != 1
+        assert underlying_fs.checking.wait(5)
+        assert underlying_fs.getattrs.count('/a/f') == 2
+        assert cacher.refreshing == set([(cacher._check_stat, '/a/f')])
+
+        # the refresh thread is busy, /a/b/g fills the queue and /h is
+        # checked right away
+        cacher.getattr('/a/b/g')
+        cacher.getattr('/a/b/g')
+        assert cacher.refresh_queue.qsize() == 1
+        assert underlying_fs.getattrs.count('/a/b/g') == 1
+        cacher.getattr('/h')
+        assert underlying_fs.getattrs.count('/h') == 2
+    finally:
+        underlying_fs.released.set()
+        cacher.stop()
+
+    assert cacher.getattr('/a/f').st_mtime == 1
+    assert underlying_fs.getattrs.count('/a/b/g') == 2
+    assert cacher.refreshing == set()
+
+
+def test_stale_attributes_past_max_stale(dirs):
+    target_dir, cache_dir = dirs
+    underlying_fs = RecordingFs(target_dir)
+    cacher = Cacher(cache_dir, underlying_fs, attr_timeout=0.05, max_stale=0.05)
+    cacher.start()
+    try:
+        cacher.read('/a/b/g', 3, 0)
+        time.sleep(0.15)
+        with open(os.path.join(target_dir, 'a', 'b', 'g'), 'wb') as f:
+            f.write('yyyy')
+
+        # checked before returning
+        assert cacher.getattr('/a/b/g').st_size == 4
+        assert underlying_fs.getattrs.count('/a/b/g') == 2
+        assert cacher.read('/a/b/g', 4, 0) == 'yyyy'
+    finally:
+        cacher.stop()
+
+
+def test_negative_timeout(dirs):
+    target_dir, cache_dir = dirs
+    underlying_fs = RecordingFs(target_dir)
+    cacher = Cacher(cache_dir, underlying_fs, negative_timeout=60)
+
+    for _ in range(2):
+        with pytest.raises(OSError) as e:
+            cacher.getattr('/a/x')
+        assert e.value.errno == errno.ENOENT
+    assert underlying_fs.getattrs.count('/a/x') == 1
+
+    # still reported missing until the directory is listed again
+    with open(os.path.join(target_dir, 'a', 'x'), 'wb') as f:
+        f.write('x')
+    with pytest.raises(OSError):
+        cacher.getattr('/a/x')
+    assert 'x' in [entry.name for entry in cacher.readdir('/a', 0)]
+    assert cacher.getattr('/a/x').st_size == 1
+
+    # or until negative_timeout expires
+    cacher = Cacher(cache_dir, underlying_fs, negative_timeout=0.05)
+    with pytest.raises(OSError):
+        cacher.getattr('/a/y')
+    with open(os.path.join(target_dir, 'a', 'y'), 'wb') as f:
+        f.write('y')
+    with pytest.raises(OSError):
+        cacher.getattr('/a/y')
+    time.sleep(0.1)
+    assert cacher.getattr('/a/y').st_size == 1
+
+
+def test_prefetch_copies(dirs):
+    target_dir, cache_dir = dirs
+    underlying_fs = RecordingFs(target_dir)
+    cacher = Cacher(cache_dir, underlying_fs, block_size=4096)
+    cacher.read('/a/f', 4096, 8192)
+    del underlying_fs.reads[:], underlying_fs.copies[:]
+
+    assert cacher.prefetch('/a/f', chunk_size=30000) == 100000 - 4096
+    assert underlying_fs.reads == []
+    assert underlying_fs.copies == [(0, 8192), (12288, 32768), (45056, 32768), (77824, 24576)]
+    assert cacher.get_cached_blocks('/a/f').number() == 102400
+    assert cacher.read('/a/f', 100, 99950) == 'x' * 50
+    assert underlying_fs.reads == []
+
+
+def test_read_hit_ratio(cacher):
+    cacher.read('/a/f', 4096, 0)
+    cacher.read('/a/f', 4096, 2048)
+    cacher.read('/a/f', 4096, 99000)
+
+    counters, gauges = cacher.get_metrics()
+    assert counters.counters['read_bytes'] == 4096 + 4096 + 1000
+    assert counters.counters['read_hit_bytes'] == 2048
+    assert counters.counters['read_miss_bytes'] == 4096 + 2048 + 1000
+    assert gauges['read_hit_ratio'] == 2048 / 9192.0
+
+
+def test_write_behind_failure(dirs):
+    target_dir, cache_dir = dirs
+    cacher = Cacher(cache_dir, UnderlyingFs(target_dir), max_readahead=65536)
+    cacher.read('/a/f', 4096, 0)
+
+    def fail(filename, data, offset):
+        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC), filename)
+
+    # storing the data fetched and the read-ahead fail
+    cacher.cache_data_files.write = fail
+    assert cacher.read('/a/f', 4096, 4096) == 'x' * 4096
+    assert not cacher.fetches
+
+    reader = threading.Thread(target=cacher.read, args=('/a/f', 4096, 8192))
+    reader.start()
+    reader.join(5)
+    assert not reader.is_alive()
+
+
+def test_write_behind_queue(dirs):
+    target_dir, cache_dir = dirs
+    cacher = Cacher(cache_dir, UnderlyingFs(target_dir), max_write_behind=1, write_threads=1)
+    cacher.start()
+
+    # the write thread is busy and the queue full
+    running = threading.Event()
+    blocked = threading.Event()
+    results = []
+
+    def block(blocked):
+        running.set()
+        blocked.wait(5)
+
+    cacher._write_behind(block, blocked)  # pylint: disable=protected-access
+    assert running.wait(5)
+    cacher._write_behind(results.append, 1)  # pylint: disable=protected-access
+
+    reader = threading.Thread(target=cacher.read, args=('/a/f', 4096, 0))
+    reader.start()
+    reader.join(0.1)
+    assert reader.is_alive()
+
+    blocked.set()
+    reader.join(5)
+    assert not reader.is_alive()
+    assert results == [1]
+
+    # tasks still queued are done before the Ranges are written
+    blocked = threading.Event()
+    cacher._write_behind(block, blocked)  # pylint: disable=protected-access
+    threading.Timer(0.1, blocked.set).start()
+    cacher.read('/a/b/g', 3, 0)
+    cacher.stop()
+
+    cacher = Cacher(cache_dir, UnderlyingFs(target_dir))
+    assert cacher.get_cached_blocks('/a/f').number() == 4096
+    assert cacher.get_cached_blocks('/a/b/g').number() == 3
+
+
+def test_write_behind_errors_logged(dirs):
+    target_dir, cache_dir = dirs
+    underlying_fs = RecordingFs(target_dir)
+    cacher = Cacher(cache_dir, underlying_fs)
+    cacher.start()
+
+    def fail(filename, data, offset):
+        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC), filename)
+
+    cacher.cache_data_files.write = fail
+    try:
+        # the reader gets its data and the next one fetches it again
+        for _ in range(2):
+            assert cacher.read('/a/b/g', 3, 0) == 'xxx'
+            for _ in range(100):
+                if not cacher.fetches:
+                    break
+                time.sleep(0.01)
+        assert underlying_fs.reads == [(0, 3), (0, 3)]
+        assert cacher.get_cached_blocks('/a/b/g').number() == 0
+    finally:
+        cacher.stop()
@@ -0,0 +1,85 @@
+#For pytest, pylint: disable=redefined-outer-name
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from pcachefs.filepool import (FilePool, MappedFiles)
+
+
+@pytest.fixture
+def filenames():
+    dir = tempfile.mkdtemp()
+    names = []
+    for i in range(5):
+        name = os.path.join(dir, str(i))
+        with open(name, 'wb') as f:
+            f.write('0123456789')
+        names.append(name)
+    yield names
+    shutil.rmtree(dir)
+
+
+def test_read_write(filenames):
+    pool = FilePool(os.O_RDWR)
+    pool.write(filenames[0], 'abc', 2)
+    assert pool.read(filenames[0], 5, 1) == '1abc5'
+    assert pool.read(filenames[0], 100, 8) == '89'
+    pool.close_all()
+
+
+def test_least_recently_used_closed(filenames):
+    pool = FilePool(max_files=2)
+    for name in filenames:
+        pool.read(name, 1, 0)
+    assert list(pool.files) == filenames[-2:]
+
+    pool.read(filenames[-2], 1, 0)
+    assert list(pool.files) == [filenames[-1], filenames[-2]]
+
+    pool.close(filenames[-1])
+    assert list(pool.files) == [filenames[-2]]
+    pool.close_all()
+    assert not pool.files
+
+
+def test_copy(filenames):
+    source = FilePool()
+    dest = FilePool(os.O_RDWR)
+    assert source.copy(filenames[0], dest, filenames[1], 3, 2) == 3
+    assert source.copy(filenames[0], dest, filenames[1], 100, 8) == 2
+    with open(filenames[0], 'wb') as f:
+        f.write('abcdefghij')
+    assert source.copy(filenames[0], dest, filenames[1], 3, 4) == 3
+    dest.close_all()
+    source.close_all()
+    with open(filenames[1], 'rb') as f:
+        assert f.read() == '0123efg789'
+
+
+def test_mapped_files(filenames):
+    mapped = MappedFiles(max_files=2)
+    for name in filenames:
+        assert mapped.read(name, 3, 2) == '234'
+    assert list(mapped.maps) == filenames[-2:]
+
+    # writes are visible through the mapping
+    FilePool(os.O_RDWR).write(filenames[-1], 'abc', 0)
+    assert mapped.read(filenames[-1], 4, 0) == 'abc3'
+
+    # the mapping is refreshed once the file grows
+    with open(filenames[-1], 'ab') as f:
+        f.write('xyz')
+    assert mapped.read(filenames[-1], 5, 8) == '89xyz'
+
+    mapped.close(filenames[-1])
+    assert list(mapped.maps) == [filenames[-2]]
+    mapped.close_all()
+    assert not mapped.maps
+
+
+def test_mapped_files_empty(filenames):
+    open(filenames[0], 'wb').close()
+    assert MappedFiles().read(filenames[0], 10, 0) is None
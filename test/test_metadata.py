@@ -0,0 +1,96 @@
+#For pytest, pylint: disable=redefined-outer-name
+
+import os
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+from pcachefs.metadata import FileMetadataStore, SqliteMetadataStore
+
+
+@pytest.fixture(params=[FileMetadataStore, SqliteMetadataStore])
+def store(request):
+    dir = tempfile.mkdtemp()
+    yield request.param(dir)
+    shutil.rmtree(dir)
+
+
+def test_stat_and_listing(store):
+    assert store.get_stat('/a') is None
+    store.put_stat('/a', {'st_size': 3})
+    assert store.get_stat('/a') == {'st_size': 3}
+
+    assert store.get_listing('/') is None
+    store.put_listing('/', [('.', 4), ('..', 4), ('a', 8)])
+    assert list(store.get_listing('/')) == [('.', 4), ('..', 4), ('a', 8)]
+
+    store.put_stats([('/b', {'st_size': 1}), ('/c', {'st_size': 2})])
+    assert store.get_stat('/c') == {'st_size': 2}
+
+    store.remove_stat('/a')
+    store.remove_listing('/')
+    assert store.get_stat('/a') is None
+    assert store.get_listing('/') is None
+
+
+def test_listing_offset(store):
+    listing = [('entry%d' % i, i % 16) for i in range(2500)]
+    store.put_listing('/big', listing)
+    assert list(store.get_listing('/big')) == listing
+    assert list(store.get_listing('/big', 1234)) == listing[1234:]
+    assert list(store.get_listing('/big', 2500)) == []
+
+    store.put_listing('/big', [])
+    assert list(store.get_listing('/big')) == []
+
+
+def test_coverage(store):
+    assert store.get_coverage('/a') is None
+    store.put_coverage('/a', 'PCFR\x00\x01')
+    assert store.get_coverage('/a') == 'PCFR\x00\x01'
+    store.remove_coverage('/a')
+    assert store.get_coverage('/a') is None
+
+
+def test_list_data(store):
+    os.makedirs(os.path.join(store.cachedir, 'a'))
+    with open(os.path.join(store.cachedir, 'a', 'cache.data'), 'wb') as f:
+        f.write('x' * 10000)
+    store.put_coverage('/a', 'coverage')
+    store.touch_data('/a')
+    store.commit()
+
+    [(_, path, size)] = store.list_data()
+    assert path == '/a'
+    assert size >= 10000
+
+    # before its coverage is written
+    os.makedirs(os.path.join(store.cachedir, 'b'))
+    with open(os.path.join(store.cachedir, 'b', 'cache.data'), 'wb') as f:
+        f.write('x' * 10000)
+    assert sorted(path for _, path, _ in store.list_data()) == ['/a', '/b']
+
+
+def test_listing_replaced_concurrently(store):
+    listings = [[('a%d' % i, 8) for i in range(50)], [('b%d' % i, 4) for i in range(50)]]
+    store.put_listing('/d', listings[0])
+    stop = threading.Event()
+
+    def replace():
+        i = 0
+        while not stop.is_set():
+            i += 1
+            store.put_listing('/d', listings[i % 2])
+
+    thread = threading.Thread(target=replace)
+    thread.start()
+    try:
+        for _ in range(300):
+            listing = store.get_listing('/d')
+            assert listing is not None
+            assert list(listing) in listings
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,59 @@
+import json
+import thread
+import threading
+
+from pcachefs.metrics import Metrics, format_json, format_prometheus
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.inc('reads')
+    metrics.inc('bytes', 10)
+    metrics.observe('read', 0.002)
+    metrics.observe('read', 10)
+
+    done = threading.Semaphore(0)
+
+    def update():
+        for _ in range(1000):
+            metrics.inc('reads')
+        done.release()
+
+    # threads not started by threading, like those of FUSE
+    for _ in range(4):
+        thread.start_new_thread(update, ())
+    for _ in range(4):
+        done.acquire()
+
+    # a thread reusing the identifier of one which ended reuses its
+    # shard, so there are at most 5 of them
+    metrics.inc('reads')
+    snapshot = metrics.snapshot()
+    assert snapshot.counters == {'reads': 4002, 'bytes': 10}
+    assert 2 <= len(metrics.shards) <= 5
+
+    histogram = snapshot.histograms['read']
+    assert histogram[3] == 1
+    assert histogram[-2] == 1
+    assert histogram[-1] == 10.002
+
+
+def test_format():
+    metrics = Metrics()
+    metrics.inc('reads', 3)
+    metrics.observe('read', 0.002)
+    snapshot = metrics.snapshot()
+
+    result = json.loads(format_json(snapshot, {'size': 5}))
+    assert result['counters'] == {'reads': 3}
+    assert result['gauges'] == {'size': 5}
+    assert result['histograms']['read']['count'] == 1
+    assert result['histograms']['read']['buckets'][2] == [0.001, 0]
+    assert result['histograms']['read']['buckets'][3] == [0.005, 1]
+
+    lines = format_prometheus(snapshot, {'size': 5}).splitlines()
+    assert 'pcachefs_reads_total 3' in lines
+    assert 'pcachefs_read_seconds_bucket{le="0.005"} 1' in lines
+    assert 'pcachefs_read_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'pcachefs_read_seconds_count 1' in lines
+    assert 'pcachefs_size 5' in lines
@@ -0,0 +1,74 @@
+import logging
+import time
+
+import pytest
+
+from pcachefs.pcachefsutil import (LRUCache, RateLimiter, configure_logging, format_size, get_logger,
+                                   parse_log_levels, parse_log_sampling, parse_size)
+
+
+def test_parse_size():
+    assert parse_size('123') == 123
+    assert parse_size('4k') == 4096
+    assert parse_size('1M') == 1024 ** 2
+    assert parse_size('500G') == 500 * 1024 ** 3
+
+
+def test_format_size():
+    assert format_size(123) == '123'
+    assert format_size(1536) == '1.5K'
+    assert format_size(500 * 1024 ** 3) == '500.0G'
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(1000)
+    start = time.time()
+    for _ in range(5):
+        limiter.consume(50)
+    assert 0.2 <= time.time() - start < 1
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert cache.pop('a') == 1
+    assert len(cache) == 1
+
+
+def test_parse_log_levels():
+    assert parse_log_levels('info') == (logging.INFO, {})
+    assert parse_log_levels('warning,cacher=DEBUG') == (logging.WARNING, {'cacher': logging.DEBUG})
+    assert parse_log_sampling('') == {}
+    assert parse_log_sampling('fs=100,cacher=10') == {'fs': 100, 'cacher': 10}
+    with pytest.raises(ValueError):
+        parse_log_levels('verbose')
+    with pytest.raises(ValueError):
+        parse_log_sampling('fs=0')
+
+
+def test_configure_logging(tmpdir):
+    filename = str(tmpdir.join('log'))
+    log = get_logger('test')
+
+    configure_logging('info,test=debug', 'test=2', filename)
+    for i in range(4):
+        log.debug('debug %d', i)
+    log.info('info %s', 'message')
+
+    configure_logging('warning', '', filename)
+    log.info('not %s', 'logged')
+
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    assert [line.split(': ', 1)[1] for line in lines] == ['debug 0', 'debug 2', 'info message']
+
+    with pytest.raises(ValueError):
+        configure_logging('warning,unknown=debug')
+    configure_logging()
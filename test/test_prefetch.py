@@ -0,0 +1,51 @@
+import os
+import time
+
+from pcachefs.prefetch import Prefetcher, PrefetchStatus
+
+
+def test_prefetch(cacher):
+    prefetcher = Prefetcher(cacher, chunk_size=4096)
+    assert prefetcher.status('/a') is None
+
+    prefetcher.start()
+    prefetcher.prefetch('/a')
+    for _ in range(100):
+        status = prefetcher.status('/a')
+        if status.completed == 100003:
+            break
+        time.sleep(0.01)
+    prefetcher.stop()
+
+    assert (status.queued, status.in_progress, status.fetched, status.errors) == (0, 0, 100003, 0)
+    assert cacher.get_cached_blocks('/a/f').number() == 100000
+    assert cacher.get_cached_blocks('/h').number() == 0
+
+
+def test_prefetch_links(dirs, cacher):
+    target_dir, _ = dirs
+    os.symlink('missing', os.path.join(target_dir, 'a', 'broken'))
+    os.symlink('..', os.path.join(target_dir, 'a', 'b', 'up'))
+
+    prefetcher = Prefetcher(cacher, chunk_size=4096)
+    prefetcher.start()
+    prefetcher.prefetch('/a')
+    for _ in range(100):
+        status = prefetcher.status('/a')
+        if status.completed >= 100003 and status.errors >= 1:
+            break
+        time.sleep(0.01)
+    time.sleep(0.05)
+    prefetcher.stop()
+
+    # the broken link is counted as an error, each directory listed once
+    assert (status.queued, status.in_progress, status.completed, status.errors) == (0, 0, 100003, 1)
+    assert len(status.visited) == 2
+
+
+def test_status_format():
+    status = PrefetchStatus()
+    empty = status.format()
+    status.completed = 12345
+    assert len(status.format()) == len(empty)
+    assert 'completed' in status.format()
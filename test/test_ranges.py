@@ -0,0 +1,105 @@
+import pickle
+import time
+
+import pytest
+
+from pcachefs.ranges import Range, Ranges, BlockBitmap, deserialize
+
+
+def as_tuples(ranges):
+    return [(r.start, r.end) for r in ranges]
+
+
+def test_add_range_merges():
+    ranges = Ranges()
+    ranges.add_range(Range(0, 3))
+    ranges.add_range(Range(6, 10))
+    assert as_tuples(ranges.ranges) == [(0, 3), (6, 10)]
+    ranges.add_range(Range(7, 15))
+    assert as_tuples(ranges.ranges) == [(0, 3), (6, 15)]
+    ranges.add_range(Range(3, 5))
+    assert as_tuples(ranges.ranges) == [(0, 5), (6, 15)]
+    ranges.add_range(Range(5, 6))
+    assert as_tuples(ranges.ranges) == [(0, 15)]
+    ranges.add_range(Range(1, 3))
+    assert as_tuples(ranges.ranges) == [(0, 15)]
+    assert ranges.start == 0
+    assert ranges.end == 15
+    assert ranges.number() == 15
+
+
+def test_contains():
+    ranges = Ranges().add_ranges([Range(0, 3), Range(5, 10)])
+    assert ranges.contains(3)
+    assert not ranges.contains(4)
+    assert ranges.contains(Range(5, 10))
+    assert not ranges.contains(Range(2, 6))
+
+
+def test_get_uncovered_portions():
+    ranges = Ranges().add_ranges([Range(0, 3), Range(5, 10), Range(12, 15)])
+    assert as_tuples(ranges.get_uncovered_portions(Range(2, 13))) == [(3, 5), (10, 12)]
+    assert as_tuples(ranges.get_uncovered_portions(Range(10, 12))) == [(10, 12)]
+    assert as_tuples(ranges.get_uncovered_portions(Range(6, 8))) == []
+    assert as_tuples(ranges.get_uncovered_portions(Range(14, 20))) == [(15, 20)]
+    assert as_tuples(Ranges().get_uncovered_portions(Range(1, 2))) == [(1, 2)]
+
+
+def test_unpickle_list_of_range():
+    # Ranges used to be pickled as a list of Range objects
+    ranges = Ranges.__new__(Ranges)
+    ranges.__setstate__({'ranges': [Range(0, 3), Range(6, 10)], 'start': 0, 'end': 10})
+    assert as_tuples(ranges.ranges) == [(0, 3), (6, 10)]
+
+    ranges = pickle.loads(pickle.dumps(ranges))
+    assert as_tuples(ranges.ranges) == [(0, 3), (6, 10)]
+
+
+def test_many_fragments():
+    ranges = Ranges()
+    before = time.time()
+    for i in range(100000):
+        ranges.add_range(Range(i * 10, i * 10 + 5))
+    for i in range(10000):
+        ranges.get_uncovered_portions(Range(i * 97, i * 97 + 30))
+    assert len(ranges.starts) == 100000
+    assert time.time() - before < 10
+
+
+def test_serialize():
+    ranges = Ranges().add_ranges([Range(0, 3), Range(5, 2 ** 40)])
+    data = ranges.serialize()
+    assert len(data) == 16 + 2 * 16
+    assert as_tuples(Ranges.deserialize(data).ranges) == [(0, 3), (5, 2 ** 40)]
+    assert as_tuples(Ranges.deserialize(Ranges().serialize()).ranges) == []
+
+
+def test_deserialize_pickle_fails():
+    with pytest.raises(ValueError):
+        Ranges.deserialize(pickle.dumps(Ranges()))
+
+
+def test_block_bitmap_aligned_portions():
+    blocks = BlockBitmap(10)
+    assert as_tuples(blocks.get_uncovered_portions(Range(15, 32))) == [(10, 40)]
+    blocks.add_ranges([Range(10, 20), Range(30, 40)])
+    assert as_tuples(blocks.get_uncovered_portions(Range(15, 32))) == [(20, 30)]
+    assert as_tuples(blocks.get_uncovered_portions(Range(5, 45))) == [(0, 10), (20, 30), (40, 50)]
+    assert blocks.contains(Range(12, 18))
+    assert not blocks.contains(Range(12, 25))
+    assert blocks.number() == 20
+
+
+def test_block_bitmap_partial_blocks_not_covered():
+    blocks = BlockBitmap(10).add_range(Range(5, 25))
+    assert as_tuples(blocks.ranges) == [(10, 20)]
+    assert blocks.start == 10
+    assert blocks.end == 20
+
+
+def test_deserialize_either_format():
+    blocks = BlockBitmap(4096).add_range(Range(0, 3 * 4096))
+    assert as_tuples(deserialize(blocks.serialize()).ranges) == [(0, 3 * 4096)]
+    assert deserialize(blocks.serialize()).block_size == 4096
+    ranges = Ranges().add_range(Range(1, 2))
+    assert as_tuples(deserialize(ranges.serialize()).ranges) == [(1, 2)]
@@ -0,0 +1,67 @@
+import json
+import os
+import signal
+import time
+
+import pytest
+
+from pcachefs.tracing import SignalDumper, Tracer, traced
+
+
+class Traced(object):
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    @traced('Traced.read')
+    def read(self, path):
+        with self.tracer.span('Traced.read.inner', size=1):
+            if path == '/missing':
+                raise IOError(path)
+        return path
+
+
+def test_tracer():
+    tracer = Tracer(max_spans=3)
+    traced_object = Traced(tracer)
+    traced_object.read('/a')
+    assert not tracer.spans
+
+    tracer.enabled = True
+    assert traced_object.read('/a') == '/a'
+    with pytest.raises(IOError):
+        traced_object.read('/missing')
+
+    # only the last 3 spans are kept
+    assert [span[0] for span in tracer.spans] == ['Traced.read', 'Traced.read.inner', 'Traced.read']
+    assert tracer.spans[-1][4] == {'path': '/missing', 'error': 'IOError'}
+
+    events = json.loads(tracer.dump())['traceEvents']
+    spans = [event for event in events if event['ph'] == 'X']
+    assert [event['name'] for event in spans] == ['Traced.read', 'Traced.read.inner', 'Traced.read']
+    assert spans[1]['args'] == {'size': 1, 'error': 'IOError'}
+    assert spans[0]['ts'] <= spans[1]['ts']
+    assert any(event['ph'] == 'M' and event['args']['name'] == 'MainThread' for event in events)
+
+
+def test_signal_dumper(tmpdir):
+    filename = str(tmpdir.join('trace.json'))
+    tracer = Tracer(enabled=True)
+    with tracer.span('span'):
+        pass
+
+    handler = signal.getsignal(signal.SIGUSR1)
+    dumper = SignalDumper(tracer, filename)
+    try:
+        dumper.start()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        for _ in range(100):
+            if os.path.exists(filename):
+                break
+            time.sleep(0.01)
+    finally:
+        dumper.stop()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGUSR1, handler)
+
+    with open(filename) as f:
+        assert json.load(f)['traceEvents'][0]['name'] == 'span'
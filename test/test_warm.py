@@ -0,0 +1,18 @@
+from StringIO import StringIO
+
+from pcachefs.warm import Warmer
+
+
+def test_warm(cacher):
+    out = StringIO()
+
+    warmer = Warmer(cacher, threads=2, max_bandwidth=10 * 1024 * 1024, chunk_size=4096, out=out)
+    assert warmer.warm(['/a'])
+    assert (warmer.files, warmer.fetched, warmer.errors) == (2, 100003, 0)
+    assert out.getvalue().startswith('2 files, 97.7K fetched')
+    assert cacher.get_cached_blocks('/a/f').number() == 100000
+
+    # only what is not cached yet is fetched
+    warmer = Warmer(cacher, out=out)
+    assert warmer.warm(['/'])
+    assert (warmer.files, warmer.fetched) == (3, 0)